@@ -0,0 +1,441 @@
+"""Offline load test for the chat app.
+
+Swaps the Gemini and Firestore clients in main.py for local fakes, serves the app from a child process
+(so the load generator does not share its interpreter) and drives `/`, `/stream_chat` and `/history`
+with concurrent simulated users. Prints a summary and writes the
+results as JSON so runs can be compared:
+
+    python benchmark.py --users 50 --duration 30 --output run.json
+    python benchmark.py --users 50 --duration 30 --compare run.json
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import math
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import main
+
+# --- Fake Gemini ---
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGenAI:
+    """Stands in for the google.generativeai module with a tunable streaming model."""
+
+    def __init__(self, first_token_ms=300, chunk_chars=40, chunks=30, chunk_interval_ms=20, jitter=0.2, model_overrides=None):
+        self.settings = {'first_token_ms': first_token_ms, 'chunk_chars': chunk_chars, 'chunks': chunks,
+                         'chunk_interval_ms': chunk_interval_ms, 'jitter': jitter}
+        self.model_overrides = model_overrides or {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        pass
+
+    def GenerationConfig(self, **kwargs):
+        return kwargs
+
+    def GenerativeModel(self, model_name, generation_config=None, system_instruction=None):
+        return FakeModel(self, model_name)
+
+    def settings_for(self, model_name):
+        return dict(self.settings, **self.model_overrides.get(model_name, {}))
+
+class FakeModel:
+    def __init__(self, genai, model_name):
+        self.genai = genai
+        self.model_name = model_name
+
+    def start_chat(self, history=None):
+        return FakeChat(self)
+
+    def generate_content(self, prompt):
+        time.sleep(self.genai.settings_for(self.model_name)['first_token_ms'] / 1000)
+        return FakeResponse("(要約) " + prompt[-200:])
+
+class FakeChat:
+    def __init__(self, model):
+        self.model = model
+
+    def _plan(self):
+        with self.model.genai._lock:
+            self.model.genai.calls += 1
+        s = self.model.genai.settings_for(self.model.model_name)
+        jitter = lambda ms: ms / 1000 * random.uniform(1 - s['jitter'], 1 + s['jitter'])
+        text = "これはベンチマーク用の応答です。" * (s['chunk_chars'] // 8 + 1)
+        return jitter(s['first_token_ms']), [(jitter(s['chunk_interval_ms']), text[:s['chunk_chars']]) for _ in range(s['chunks'])]
+
+    def send_message(self, prompt, stream=True):
+        first_delay, chunks = self._plan()
+        def generate():
+            time.sleep(first_delay)
+            for i, (delay, text) in enumerate(chunks):
+                if i: time.sleep(delay)
+                yield FakeChunk(text)
+        return generate()
+
+    async def send_message_async(self, prompt, stream=True):
+        first_delay, chunks = self._plan()
+        async def generate():
+            await asyncio.sleep(first_delay)
+            for i, (delay, text) in enumerate(chunks):
+                if i: await asyncio.sleep(delay)
+                yield FakeChunk(text)
+        return generate()
+
+# --- Fake Firestore ---
+class FakeFirestore:
+    """In-memory subset of the Firestore client used by main.py, with injectable latency."""
+
+    def __init__(self, read_ms=20, write_ms=30):
+        self.read_ms = read_ms
+        self.write_ms = write_ms
+        self.docs = {}  # path tuple -> dict
+        self.reads = 0
+        self.writes = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollection(self, (name,))
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def _read(self):
+        with self._lock:
+            self.reads += 1
+        time.sleep(self.read_ms / 1000)
+
+    def _write(self, ops):
+        with self._lock:
+            self.writes += 1
+            for path, data, merge in ops:
+                if merge: self.docs.setdefault(path, {}).update(data)
+                else: self.docs[path] = dict(data)
+        time.sleep(self.write_ms / 1000)
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.db, self.path + (name,))
+
+    def get(self):
+        self.db._read()
+        return FakeSnapshot(self.id, self.db.docs.get(self.path))
+
+    def set(self, data, merge=False):
+        self.db._write([(self.path, data, merge)])
+
+    def delete(self):
+        with self.db._lock:
+            self.db.docs.pop(self.path, None)
+        time.sleep(self.db.write_ms / 1000)
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data[field]
+
+class FakeCollection:
+    def __init__(self, db, path, order=None, descending=False, limit_to=None, after=None):
+        self.db = db
+        self.path = path
+        self._order = order
+        self._descending = descending
+        self._limit = limit_to
+        self._after = after
+
+    def document(self, doc_id=None):
+        return FakeDocument(self.db, self.path + (doc_id or f"{next(self.db._ids):012d}",))
+
+    def add(self, data):
+        self.document().set(data)
+
+    def order_by(self, field, direction='ASCENDING'):
+        return FakeCollection(self.db, self.path, field, direction == 'DESCENDING', self._limit, self._after)
+
+    def limit(self, count):
+        return FakeCollection(self.db, self.path, self._order, self._descending, count, self._after)
+
+    def start_after(self, cursor):
+        return FakeCollection(self.db, self.path, self._order, self._descending, self._limit, cursor)
+
+    def stream(self):
+        self.db._read()
+        with self.db._lock:
+            docs = [(path[-1], data) for path, data in self.db.docs.items() if path[:-1] == self.path]
+        if self._order:
+            docs.sort(key=lambda d: d[1][self._order], reverse=self._descending)
+        if self._after is not None:
+            cursor = self._after.to_dict() if isinstance(self._after, FakeSnapshot) else self._after
+            bound = cursor[self._order]
+            docs = [d for d in docs if (d[1][self._order] < bound if self._descending else d[1][self._order] > bound)]
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return iter([FakeSnapshot(doc_id, dict(data)) for doc_id, data in docs])
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def set(self, ref, data, merge=False):
+        self.ops.append((ref.path, data, merge))
+
+    def commit(self):
+        self.db._write(self.ops)
+
+def seed_history(db, user_ids, turns):
+    start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)
+    for user_id in user_ids:
+        convo = db.collection('users').document(user_id).collection('conversations')
+        for i in range(turns):
+            turn = {'role': 'user' if i % 2 == 0 else 'model', 'text': f"過去の会話 {i} " * 10, 'timestamp': start + datetime.timedelta(seconds=i)}
+            db.docs[convo.document(main.turn_doc_id(turn)).path] = turn
+
+# --- Server ---
+def start_server(mode, port):
+    if mode == 'asgi':
+        import uvicorn
+        server = uvicorn.Server(uvicorn.Config(main.asgi_app, host='127.0.0.1', port=port, log_level='warning'))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started: time.sleep(0.05)
+        return lambda: (setattr(server, 'should_exit', True), thread.join())
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', port, main.app, threaded=True)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.shutdown
+
+def bench_user_ids(args):
+    return [f"bench-user-{i}" for i in range(args.users)]
+
+def serve(args, stats_path):
+    # Child side of main_cli: fakes and seed data live here, with the app. Serves until stdin closes.
+    genai = FakeGenAI(args.first_token_ms, args.chunk_chars, args.chunks, args.chunk_interval_ms,
+                      model_overrides={'gemini-2.5-pro': {'first_token_ms': args.pro_first_token_ms}})
+    db = FakeFirestore(args.firestore_read_ms, args.firestore_write_ms)
+    main.genai_client = genai
+    main.db_client = db
+    main.user_rate_limiter = main.TokenBucketLimiter(args.user_rate_per_minute)
+    seed_history(db, bench_user_ids(args), args.history_turns)
+    stop_server = start_server(args.server, args.port)
+    sys.stdin.read()
+    main.turn_writer.close()
+    stop_server()
+    with open(stats_path, 'w') as f:
+        json.dump({'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                   'upstream_calls': genai.calls, 'firestore_reads': db.reads, 'firestore_writes': db.writes}, f)
+    return 0
+
+def spawn_server(argv, stats_path, port, timeout=30):
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), *argv, '--serve', stats_path], stdin=subprocess.PIPE)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return child
+        except OSError:
+            if child.poll() is not None or time.monotonic() > deadline:
+                child.kill()
+                raise RuntimeError(f"benchmark server did not start on port {port}")
+            time.sleep(0.1)
+
+def session_cookie(user_id):
+    serializer = main.app.session_interface.get_signing_serializer(main.app)
+    return {main.app.config['SESSION_COOKIE_NAME']: serializer.dumps({'google_id': user_id, 'name': user_id})}
+
+# --- Load generator ---
+class Recorder:
+    def __init__(self):
+        self.samples = []  # (endpoint, status, latency, time to first chunk or None, bytes)
+        self._lock = threading.Lock()
+
+    def add(self, *sample):
+        with self._lock:
+            self.samples.append(sample)
+
+def run_user(base_url, user_id, args, deadline, recorder):
+    http = requests.Session()
+    http.cookies.update(session_cookie(user_id))
+    rng = random.Random(user_id)
+    prompts = [f"質問 {i}: このアプリの性能について教えてください。" for i in range(args.distinct_prompts)]
+    while time.monotonic() < deadline:
+        roll = rng.random()
+        if roll < args.page_ratio:
+            endpoint, call = '/', lambda: http.get(base_url + '/', stream=True)
+        elif roll < args.page_ratio + args.history_ratio:
+            endpoint, call = '/history', lambda: http.get(base_url + '/history?limit=20', stream=True)
+        else:
+            payload = {'prompt': rng.choice(prompts), 'model_name': 'gemini-1.5-flash', 'temperature': args.temperature,
+                       'system_instruction': 'あなたは親切で優秀なAIアシスタントです。', 'deep_think_mode': rng.random() < args.deep_think_ratio}
+            endpoint, call = '/stream_chat', lambda: http.post(base_url + '/stream_chat', json=payload, stream=True)
+        started = time.perf_counter()
+        first_chunk, size, status = None, 0, 0
+        try:
+            with call() as response:
+                status = response.status_code
+                # /stream_chat is server-sent events: time to first chunk is the first `id:` event, not the preamble.
+                sse = endpoint == '/stream_chat'
+                for chunk in response.iter_content(chunk_size=None):
+                    if first_chunk is None and (not sse or b'id: ' in chunk):
+                        first_chunk = time.perf_counter() - started
+                    if sse and b'event: error' in chunk:
+                        status = 0  # rejected by admission control or failed upstream
+                    size += len(chunk)
+        except requests.RequestException:
+            status = 0
+        recorder.add(endpoint, status, time.perf_counter() - started, first_chunk, size)
+        if args.think_time_ms: time.sleep(rng.uniform(0, 2 * args.think_time_ms) / 1000)
+
+def percentile(values, pct):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]  # nearest-rank
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint in sorted({s[0] for s in recorder.samples}):
+        rows = [s for s in recorder.samples if s[0] == endpoint]
+        ok = [s for s in rows if 200 <= s[1] < 400]
+        latencies = [s[2] for s in ok]
+        ttfc = [s[3] for s in ok if s[3] is not None]
+        endpoints[endpoint] = {
+            'requests': len(rows),
+            'errors': len(rows) - len(ok),
+            'throughput_rps': len(ok) / elapsed,
+            'bytes_per_second': sum(s[4] for s in ok) / elapsed,
+            'latency_ms': {f'p{p}': round(percentile(latencies, p) * 1000, 2) if latencies else None for p in (50, 95, 99)},
+            'ttfc_ms': {f'p{p}': round(percentile(ttfc, p) * 1000, 2) if ttfc else None for p in (50, 95, 99)},
+        }
+    return endpoints
+
+def compare(current, baseline, tolerance):
+    regressions = []
+    for endpoint, stats in current['endpoints'].items():
+        base = baseline.get('endpoints', {}).get(endpoint)
+        if not base: continue
+        for group in ('latency_ms', 'ttfc_ms'):
+            for pct, value in stats[group].items():
+                old = base[group].get(pct)
+                if value is None or not old: continue
+                change = (value - old) / old
+                print(f"  {endpoint:<12} {group:<10} {pct:<4} {old:>9.1f} -> {value:>9.1f} ({change:+.1%})")
+                if change > tolerance: regressions.append(f"{endpoint} {group} {pct} {change:+.1%}")
+        old_rps, rps = base['throughput_rps'], stats['throughput_rps']
+        if old_rps and (old_rps - rps) / old_rps > tolerance:
+            regressions.append(f"{endpoint} throughput {(rps - old_rps) / old_rps:+.1%}")
+    old_rss, rss = baseline.get('peak_rss_mb'), current['peak_rss_mb']
+    if old_rss and (rss - old_rss) / old_rss > tolerance:
+        regressions.append(f"peak RSS {old_rss:.0f}MB -> {rss:.0f}MB")
+    return regressions
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='asgi')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--users', type=int, default=20, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load')
+    parser.add_argument('--think-time-ms', type=float, default=200)
+    parser.add_argument('--page-ratio', type=float, default=0.1)
+    parser.add_argument('--history-ratio', type=float, default=0.1)
+    parser.add_argument('--deep-think-ratio', type=float, default=0.1)
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--distinct-prompts', type=int, default=50)
+    parser.add_argument('--user-rate-per-minute', type=float, default=0, help='per-user rate limit (0 = off)')
+    parser.add_argument('--history-turns', type=int, default=40, help='turns seeded per user before the run')
+    parser.add_argument('--first-token-ms', type=float, default=300)
+    parser.add_argument('--pro-first-token-ms', type=float, default=1500, help='first-token delay for gemini-2.5-pro')
+    parser.add_argument('--chunk-chars', type=int, default=40)
+    parser.add_argument('--chunks', type=int, default=30)
+    parser.add_argument('--chunk-interval-ms', type=float, default=20)
+    parser.add_argument('--firestore-read-ms', type=float, default=20)
+    parser.add_argument('--firestore-write-ms', type=float, default=30)
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--compare', help='baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression before failing')
+    parser.add_argument('--serve', metavar='STATS_PATH', help=argparse.SUPPRESS)
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = parser.parse_args(argv)
+    if args.serve: return serve(args, args.serve)
+
+    user_ids = bench_user_ids(args)
+    fd, stats_path = tempfile.mkstemp(prefix='benchmark-server-', suffix='.json')
+    os.close(fd)
+    server = spawn_server(argv, stats_path, args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+    recorder = Recorder()
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=run_user, args=(base_url, user_id, args, deadline, recorder)) for user_id in user_ids]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.monotonic() - started
+    server.stdin.close()
+    server.wait()
+    with open(stats_path) as f:
+        server_stats = json.load(f)
+    os.unlink(stats_path)
+
+    results = {
+        'config': {k: v for k, v in vars(args).items() if k != 'serve'},
+        'elapsed_seconds': elapsed,
+        'endpoints': summarize(recorder, elapsed),
+        **server_stats,
+    }
+    for endpoint, stats in results['endpoints'].items():
+        print(f"{endpoint:<12} n={stats['requests']:<6} err={stats['errors']:<4} rps={stats['throughput_rps']:<8.1f} "
+              f"latency p50/p95/p99={stats['latency_ms']['p50']}/{stats['latency_ms']['p95']}/{stats['latency_ms']['p99']}ms "
+              f"ttfc p50/p95/p99={stats['ttfc_ms']['p50']}/{stats['ttfc_ms']['p95']}/{stats['ttfc_ms']['p99']}ms")
+    print(f"server peak RSS {results['peak_rss_mb']:.1f}MB, upstream calls {results['upstream_calls']}, "
+          f"firestore reads {results['firestore_reads']}, writes {results['firestore_writes']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"compared with {args.compare}:")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("regressions:\n  " + "\n  ".join(regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
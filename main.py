@@ -1,8 +1,29 @@
 import os
+import io
+import sys
+import re
+import math
+import heapq
+import bisect
 import datetime
 import json
+import urllib.parse
+import importlib
+import gzip
+import zlib
+import mimetypes
+import hashlib
+import copy
+import threading
+import uuid
+import queue
+import time
+import atexit
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict, deque
 import requests
-from flask import Flask, request, render_template_string, redirect, url_for, Response, stream_with_context, session, abort
+from flask import Flask, request, redirect, url_for, Response, session, abort, jsonify
 
 # --- 1. Initial Setup ---
 app = Flask(__name__)
@@ -14,6 +35,90 @@ GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
 REDIRECT_URI = os.environ.get('REDIRECT_URI')
 
+# Knowledge files are uploaded once as content-addressed blobs, then chunked and indexed server-side;
+# chats reference them by SHA-256 and only the best chunks go into each prompt.
+KNOWLEDGE_MAX_FILES = int(os.environ.get('KNOWLEDGE_MAX_FILES', '10'))
+KNOWLEDGE_MAX_FILE_BYTES = int(os.environ.get('KNOWLEDGE_MAX_FILE_BYTES', '4000000'))
+KNOWLEDGE_BLOB_CACHE_BYTES = int(os.environ.get('KNOWLEDGE_BLOB_CACHE_BYTES', '268435456'))
+KNOWLEDGE_BLOB_DIR = os.environ.get('KNOWLEDGE_BLOB_DIR')  # e.g. /tmp/knowledge-blobs
+KNOWLEDGE_INDEX_CACHE_SIZE = int(os.environ.get('KNOWLEDGE_INDEX_CACHE_SIZE', '256'))
+KNOWLEDGE_CHUNK_CHARS = int(os.environ.get('KNOWLEDGE_CHUNK_CHARS', '800'))
+KNOWLEDGE_CHUNK_OVERLAP = int(os.environ.get('KNOWLEDGE_CHUNK_OVERLAP', '100'))
+KNOWLEDGE_TOP_K = int(os.environ.get('KNOWLEDGE_TOP_K', '6'))
+KNOWLEDGE_CONTEXT_CHARS = int(os.environ.get('KNOWLEDGE_CONTEXT_CHARS', '4000'))
+
+# Logged-in conversations are assembled server-side: recent turns verbatim, older ones as a rolling summary.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '3000'))
+CONTEXT_WINDOW_TURNS = int(os.environ.get('CONTEXT_WINDOW_TURNS', '40'))  # keep below HISTORY_CACHE_TURNS
+CONTEXT_MAX_TURNS = int(os.environ.get('CONTEXT_MAX_TURNS', '100'))  # turns folded per summary call
+CONTEXT_CATCH_UP_TURNS = int(os.environ.get('CONTEXT_CATCH_UP_TURNS', '200'))  # older unsummarized history beyond this is dropped
+CONTEXT_SUMMARY_MODEL = os.environ.get('CONTEXT_SUMMARY_MODEL', 'gemini-1.5-flash')
+CONTEXT_SUMMARY_CHARS = int(os.environ.get('CONTEXT_SUMMARY_CHARS', '1500'))
+
+# Conversation turns are written behind the response stream in batched commits.
+PERSIST_BATCH_SIZE = int(os.environ.get('PERSIST_BATCH_SIZE', '200'))
+PERSIST_FLUSH_INTERVAL = float(os.environ.get('PERSIST_FLUSH_INTERVAL', '0.5'))
+PERSIST_QUEUE_SIZE = int(os.environ.get('PERSIST_QUEUE_SIZE', '5000'))
+PERSIST_ENQUEUE_TIMEOUT = float(os.environ.get('PERSIST_ENQUEUE_TIMEOUT', '1.0'))
+PERSIST_MAX_RETRIES = int(os.environ.get('PERSIST_MAX_RETRIES', '5'))
+
+# Recent history is cached per user; the page renders the latest turns and pages back through /history.
+HISTORY_CACHE_USERS = int(os.environ.get('HISTORY_CACHE_USERS', '1000'))
+HISTORY_CACHE_TURNS = int(os.environ.get('HISTORY_CACHE_TURNS', '50'))
+HISTORY_CACHE_TTL = float(os.environ.get('HISTORY_CACHE_TTL', '600'))
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '20'))
+# Bulk export/import streams NDJSON a Firestore page or batch at a time.
+HISTORY_EXPORT_PAGE_SIZE = int(os.environ.get('HISTORY_EXPORT_PAGE_SIZE', '500'))
+HISTORY_IMPORT_MAX_LINE_BYTES = int(os.environ.get('HISTORY_IMPORT_MAX_LINE_BYTES', '1048576'))
+
+# Opt-in cache of answers to identical low-temperature requests, replayed through the normal stream.
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.environ.get('RESPONSE_CACHE_MAX_TEMPERATURE', '0.3'))
+RESPONSE_CACHE_DEEP_THINK = os.environ.get('RESPONSE_CACHE_DEEP_THINK', '').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_MAX_CHARS = int(os.environ.get('RESPONSE_CACHE_MAX_CHARS', '20000000'))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '86400'))
+RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH')  # e.g. /tmp/responses.sqlite3
+RESPONSE_CACHE_REPLAY_CHARS = int(os.environ.get('RESPONSE_CACHE_REPLAY_CHARS', '256'))
+
+# Latency histograms are always collected for /metrics; this adds a one-line timing trailer per chat to the logs.
+METRICS_LOG_TIMINGS = os.environ.get('METRICS_LOG_TIMINGS', '').lower() in ('1', 'true', 'yes')
+
+# Client reuse and cold-start warm-up.
+MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', '64'))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '16'))
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', '').lower() in ('1', 'true', 'yes')
+WARMUP_URLS = ('https://oauth2.googleapis.com/', 'https://www.googleapis.com/')
+
+# Answers are buffered per stream so a dropped connection can resume with Last-Event-ID.
+STREAM_RING_CHUNKS = int(os.environ.get('STREAM_RING_CHUNKS', '2048'))
+STREAM_TTL = float(os.environ.get('STREAM_TTL', '300'))
+STREAM_MEMORY_CHARS = int(os.environ.get('STREAM_MEMORY_CHARS', '50000000'))
+STREAM_HEARTBEAT = float(os.environ.get('STREAM_HEARTBEAT', '15'))
+# Identical requests in flight at the same time share one upstream call.
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', '1').lower() in ('1', 'true', 'yes')
+
+# Admission control in front of Gemini: concurrency per model (e.g. "gemini-2.5-pro=4,gemini-1.5-flash=32")
+# and in total, a bounded priority wait queue, and a per-user token bucket.
+MODEL_CONCURRENCY = {name.strip(): int(limit) for name, _, limit in
+                     (item.partition('=') for item in os.environ.get('MODEL_CONCURRENCY', 'gemini-2.5-pro=4').split(',') if '=' in item)}
+MODEL_CONCURRENCY_DEFAULT = int(os.environ.get('MODEL_CONCURRENCY_DEFAULT', '32'))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', '48'))
+UPSTREAM_QUEUE_SIZE = int(os.environ.get('UPSTREAM_QUEUE_SIZE', '64'))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', '30'))
+USER_RATE_PER_MINUTE = float(os.environ.get('USER_RATE_PER_MINUTE', '20'))
+USER_RATE_BURST = float(os.environ.get('USER_RATE_BURST', '5'))
+
+# Hedging: if a model has not sent its first chunk within its budget (ms), a second request goes to the
+# same model and whichever answers first is streamed. Unlisted models never hedge. HEDGE_FALLBACK_MODELS
+# (e.g. gemini-2.5-pro=gemini-1.5-flash) opts a model into hedging on a different one instead.
+HEDGE_BUDGETS_MS = {name.strip(): float(ms) for name, _, ms in
+                    (item.partition('=') for item in os.environ.get('HEDGE_BUDGETS_MS', 'gemini-2.5-pro=6000').split(',') if '=' in item)}
+HEDGE_FALLBACK_MODELS = {name.strip(): model.strip() for name, _, model in
+                         (item.partition('=') for item in os.environ.get('HEDGE_FALLBACK_MODELS', '').split(',') if '=' in item)}
+
+# Under ASGI the remaining Flask routes run on their own thread pool.
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', '32'))
+
 # --- 3. Lazy Initializers ---
 db_client = None
 def get_db():
@@ -36,61 +141,1479 @@ def get_genai():
                 pass
     return genai_client
 
+OAUTH_CLIENT_CONFIG = { "web": {
+    "client_id": GOOGLE_CLIENT_ID, "client_secret": GOOGLE_CLIENT_SECRET,
+    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+    "token_uri": "https://oauth2.googleapis.com/token",
+    "redirect_uris": [REDIRECT_URI],
+}}
+OAUTH_SCOPES = ["openid", "https://www.googleapis.com/auth/userinfo.email", "https://www.googleapis.com/auth/userinfo.profile"]
+
 def get_oauth_flow():
     if not (GOOGLE_CLIENT_ID and GOOGLE_CLIENT_SECRET and REDIRECT_URI):
         return None
     from google_auth_oauthlib.flow import Flow
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
-    return Flow.from_client_config(
-        client_config={ "web": {
-            "client_id": GOOGLE_CLIENT_ID, "client_secret": GOOGLE_CLIENT_SECRET,
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "redirect_uris": [REDIRECT_URI],
-        }},
-        scopes=["openid", "https://www.googleapis.com/auth/userinfo.email", "https://www.googleapis.com/auth/userinfo.profile"],
-        redirect_uri=REDIRECT_URI
-    )
+    # A Flow carries per-login state, so it is built per request, but its token exchange reuses the shared pool.
+    flow = Flow.from_client_config(client_config=OAUTH_CLIENT_CONFIG, scopes=OAUTH_SCOPES, redirect_uri=REDIRECT_URI)
+    flow.oauth2session.mount('https://', get_http_session().get_adapter('https://'))
+    return flow
+
+http_session = None
+def get_http_session():
+    # Keep-alive connection pool for Google HTTP endpoints (OAuth token exchange, userinfo).
+    global http_session
+    if http_session is None:
+        session_ = requests.Session()
+        session_.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+        http_session = session_
+    return http_session
+
+model_cache = OrderedDict()
+model_cache_lock = threading.Lock()
+def get_model(model_name, temperature=None, system_instruction=None):
+    """Returns a GenerativeModel shared by every request with the same settings (bounded LRU)."""
+    genai_client = get_genai()
+    key = (id(genai_client), model_name, temperature, system_instruction)
+    with model_cache_lock:
+        model = model_cache.get(key)
+        if model is not None:
+            model_cache.move_to_end(key)
+            return model
+    kwargs = {'model_name': model_name}
+    if temperature is not None:
+        # ▼▼▼ BUG FIX: Access GenerationConfig through the client instance ▼▼▼
+        kwargs['generation_config'] = genai_client.GenerationConfig(temperature=temperature)
+    if system_instruction:
+        kwargs['system_instruction'] = system_instruction
+    model = genai_client.GenerativeModel(**kwargs)
+    with model_cache_lock:
+        model_cache[key] = model
+        while len(model_cache) > MODEL_CACHE_SIZE:
+            model_cache.popitem(last=False)
+    return model
+
+def warm_up():
+    # Pays the import, client construction and TLS/gRPC handshakes before the first request does.
+    started = time.perf_counter()
+    steps = [
+        ('genai', lambda: get_genai() and get_model('gemini-1.5-flash')),
+        ('firestore', lambda: get_db().collection('users').document('_warmup').get()),
+        ('oauth', lambda: GOOGLE_CLIENT_ID and importlib.import_module('google_auth_oauthlib.flow')),
+        ('http', lambda: [get_http_session().head(url, timeout=5) for url in WARMUP_URLS]),
+    ]
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            print(f"Warm-up step {name} failed: {e}")
+    print(f"Warm-up finished in {time.perf_counter() - started:.2f}s")
+
+if WARMUP_ON_START:
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+# --- 4. Metrics ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+THROUGHPUT_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+class Histogram:
+    """Prometheus-style histogram with labels, rendered in the text exposition format."""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}  # label items -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {values[-1]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+class MetricCounter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = Counter()
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines.extend(f"{self.name}{format_labels(key)} {value}" for key, value in sorted(self._values.items()))
+        return lines
+
+class GaugeCallback:
+    """Gauge whose labelled values are read from a callback at scrape time."""
+
+    def __init__(self, name, help_text, callback, metric_type='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.metric_type = metric_type
+        metrics_registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(f"{self.name}{format_labels(tuple(sorted(labels.items())))} {value}" for labels, value in self.callback())
+        return lines
+
+def format_labels(items):
+    if not items: return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in items) + '}'
+
+def render_metrics():
+    return "\n".join(line for metric in metrics_registry for line in metric.render()) + "\n"
+
+metrics_registry = []
+PROMPT_ASSEMBLY_SECONDS = Histogram('chat_prompt_assembly_seconds', 'Time to resolve settings, knowledge and history into the final prompt.')
+TIME_TO_FIRST_CHUNK_SECONDS = Histogram('chat_time_to_first_chunk_seconds', 'Time from calling Gemini to the first chunk the user receives, hedge wait included.')
+GENERATION_SECONDS = Histogram('chat_generation_seconds', 'Total time spent streaming one Gemini answer.')
+STREAM_BYTES_PER_SECOND = Histogram('chat_stream_bytes_per_second', 'Streaming throughput of one answer after its first chunk.', THROUGHPUT_BUCKETS)
+STREAM_CHUNKS = MetricCounter('chat_stream_chunks_total', 'Chunks relayed from Gemini.')
+STREAM_BYTES = MetricCounter('chat_stream_bytes_total', 'UTF-8 bytes relayed from Gemini.')
+FIRESTORE_READ_SECONDS = Histogram('firestore_read_seconds', 'Firestore read latency by operation.')
+FIRESTORE_WRITE_SECONDS = Histogram('firestore_write_seconds', 'Firestore write latency by operation.')
+OAUTH_CALLBACK_SECONDS = Histogram('oauth_callback_seconds', 'Latency of the OAuth callback (token exchange and userinfo).')
+
+class StreamTimer:
+    """Collects per-answer streaming stats; the per-chunk work is two additions."""
+
+    def __init__(self, turn):
+        self.turn = turn
+        self.started = time.perf_counter()
+        self.first_chunk_at = None
+        self.chunks = 0
+        self.bytes = 0
+
+    def chunk(self, text):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+        self.chunks += 1
+        self.bytes += len(text.encode('utf-8'))
+
+    def finish(self):
+        labels = self.turn.metric_labels()
+        ended = time.perf_counter()
+        GENERATION_SECONDS.observe(ended - self.started, **labels)
+        STREAM_CHUNKS.inc(self.chunks, **labels)
+        STREAM_BYTES.inc(self.bytes, **labels)
+        self.turn.timings['generation'] = ended - self.started
+        self.turn.timings['chunks'] = self.chunks
+        self.turn.timings['bytes'] = self.bytes
+        # Time to first chunk is recorded once by hedged_stream, which sees the latency the user does.
+        if self.first_chunk_at is not None and ended > self.first_chunk_at:
+            STREAM_BYTES_PER_SECOND.observe(self.bytes / (ended - self.first_chunk_at), **labels)
+
+# --- 5. Knowledge File Index ---
+# ASCII and non-ASCII runs are matched separately, so "gunicornを使います" yields "gunicorn" plus Japanese bigrams.
+_WORD_RE = re.compile(r'[a-z0-9_]+|[^\W\x00-\x7f]+')
+
+def tokenize(text):
+    # ASCII words are kept whole; Japanese and other unspaced scripts are split into character bigrams.
+    tokens = []
+    for word in _WORD_RE.findall(text.lower()):
+        if word.isascii() or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+def chunk_text(text, size=KNOWLEDGE_CHUNK_CHARS, overlap=KNOWLEDGE_CHUNK_OVERLAP):
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = text.rfind('\n', start + size // 2, end)
+            if cut != -1: end = cut + 1
+        chunk = text[start:end].strip()
+        if chunk: chunks.append(chunk)
+        if end >= len(text): break
+        # Overlap with the previous chunk, starting on a line boundary when there is one.
+        nl = text.find('\n', end - overlap, end - 1)
+        start = max(nl + 1 if nl != -1 else end - overlap, start + 1)
+    return chunks
+
+class KnowledgeIndex:
+    """BM25 index over the chunks of a set of knowledge files."""
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, files=None):
+        self.files = OrderedDict(files or {})
+        self._build()
+
+    def _build(self):
+        chunks, lengths, postings = [], [], {}
+        for name, content in self.files.items():
+            for text in chunk_text(content):
+                tf = Counter(tokenize(text))
+                for term, count in tf.items():
+                    postings.setdefault(term, []).append((len(chunks), count))
+                chunks.append((name, text))
+                lengths.append(sum(tf.values()) or 1)
+        avg_len = sum(lengths) / len(lengths) if lengths else 1.0
+        self._state = (chunks, lengths, postings, avg_len)
+
+    def search(self, query, top_k=KNOWLEDGE_TOP_K, budget=KNOWLEDGE_CONTEXT_CHARS):
+        chunks, lengths, postings, avg_len = self._state
+        if not chunks: return []
+        scores = {}
+        for term in set(tokenize(query)):
+            hits = postings.get(term)
+            if not hits: continue
+            idf = math.log(1 + (len(chunks) - len(hits) + 0.5) / (len(hits) + 0.5))
+            for idx, tf in hits:
+                norm = tf + self.K1 * (1 - self.B + self.B * lengths[idx] / avg_len)
+                scores[idx] = scores.get(idx, 0.0) + idf * tf * (self.K1 + 1) / norm
+        # Nothing matched (e.g. "summarize this file"): fall back to the leading chunks.
+        ranked = heapq.nlargest(top_k, scores, key=scores.get) if scores else range(min(top_k, len(chunks)))
+        picked, used = [], 0
+        for idx in ranked:
+            size = len(chunks[idx][1])
+            if used + size > budget: continue
+            picked.append(idx)
+            used += size
+        return [chunks[idx] for idx in sorted(picked)]
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+class MissingBlobs(Exception):
+    """A chat referenced knowledge blobs this instance does not hold; the client re-uploads them."""
+
+    def __init__(self, hashes):
+        super().__init__(f"missing knowledge blobs: {', '.join(hashes)}")
+        self.hashes = hashes
+
+class BlobStore:
+    """Knowledge file texts by SHA-256, shared by every user: an LRU bounded by bytes, with an optional directory behind it."""
+
+    def __init__(self, max_bytes=None, path=None):
+        self.max_bytes = max_bytes or KNOWLEDGE_BLOB_CACHE_BYTES
+        self.path = path or KNOWLEDGE_BLOB_DIR
+        self._blobs = OrderedDict()  # sha256 -> text
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = Counter()
+        if self.path: os.makedirs(self.path, exist_ok=True)
+
+    def get(self, sha256):
+        with self._lock:
+            text = self._blobs.get(sha256)
+            if text is not None:
+                self._blobs.move_to_end(sha256)
+                self.stats['hits'] += 1
+                return text
+        text = self._read_disk(sha256)
+        with self._lock:
+            self.stats['disk_hits' if text is not None else 'misses'] += 1
+            if text is not None: self._insert(sha256, text)
+        return text
+
+    def put(self, sha256, text):
+        with self._lock:
+            if sha256 in self._blobs:
+                self.stats['duplicates'] += 1
+                return
+            self._insert(sha256, text)
+            self.stats['stores'] += 1
+        if self.path and not os.path.exists(os.path.join(self.path, sha256)):
+            tmp = os.path.join(self.path, f".{sha256}.{uuid.uuid4().hex}")
+            with open(tmp, 'w', encoding='utf-8') as f: f.write(text)
+            os.replace(tmp, os.path.join(self.path, sha256))
+
+    def missing(self, hashes):
+        with self._lock:
+            unknown = [h for h in hashes if h not in self._blobs]
+        return [h for h in unknown if not (self.path and os.path.exists(os.path.join(self.path, h)))]
+
+    def _read_disk(self, sha256):
+        if not self.path: return None
+        try:
+            with open(os.path.join(self.path, sha256), encoding='utf-8') as f: return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _insert(self, sha256, text):
+        self._blobs[sha256] = text
+        self._bytes += len(text.encode('utf-8'))
+        while self._bytes > self.max_bytes and len(self._blobs) > 1:
+            _, evicted = self._blobs.popitem(last=False)
+            self._bytes -= len(evicted.encode('utf-8'))
+            self.stats['evictions'] += 1
+
+blob_store = BlobStore()
+GaugeCallback('knowledge_blob_events_total', 'Knowledge blob store lookups and maintenance events.',
+              lambda: [({'event': k}, v) for k, v in sorted(blob_store.stats.items())], metric_type='counter')
+GaugeCallback('knowledge_blob_bytes', 'Bytes of knowledge text held in memory.', lambda: [({}, blob_store._bytes)])
+
+knowledge_indexes = OrderedDict()
+knowledge_lock = threading.Lock()
+def get_knowledge_index(refs):
+    """Index over the referenced (name, sha256) files, shared by every chat that attaches the same set."""
+    key = tuple(sorted(refs))
+    with knowledge_lock:
+        index = knowledge_indexes.get(key)
+        if index is not None:
+            knowledge_indexes.move_to_end(key)
+            return index
+    texts = [(name, blob_store.get(sha256)) for name, sha256 in key]
+    missing = [sha256 for (_, sha256), (_, text) in zip(key, texts) if text is None]
+    if missing: raise MissingBlobs(missing)
+    index = KnowledgeIndex(texts)
+    with knowledge_lock:
+        knowledge_indexes[key] = index
+        while len(knowledge_indexes) > KNOWLEDGE_INDEX_CACHE_SIZE:
+            knowledge_indexes.popitem(last=False)
+    return index
+
+def build_final_prompt(user_prompt, knowledge_chunks, history_text):
+    context_header = ""
+    context_body = ""
+
+    if knowledge_chunks:
+        context_header += "知識ファイル"
+        context_body += "\n\n".join([f"--- File: {name} ---\n{text}" for name, text in knowledge_chunks])
+
+    if history_text:
+        if context_header: context_header += "と"
+        context_header += "これまでの会話履歴"
+        if context_body: context_body += "\n\n"
+        context_body += f"--- 会話履歴 ---\n{history_text}"
+
+    if not context_header:
+        return user_prompt
+    return f"以下の{context_header}を元に回答してください。\n{context_body}\n--------------\nユーザーの質問: {user_prompt}"
+
+# --- 6. Conversation History ---
+def fetch_turns(user_id, limit, before=None):
+    """Reads up to `limit` turns older than `before` (newest first in Firestore), returned oldest first."""
+    from google.cloud import firestore
+    query = get_db().collection('users').document(user_id).collection('conversations').order_by('timestamp', direction=firestore.Query.DESCENDING)
+    if before is not None:
+        query = query.start_after({'timestamp': before})
+    # Turns still sitting in the write-behind queue are not in Firestore yet. Snapshot them before the
+    # query: a batch committing in between then shows up in both (deduplicated) instead of neither.
+    pending = turn_writer.pending(user_id) if before is None else []
+    started = time.perf_counter()
+    turns = [doc.to_dict() for doc in query.limit(limit).stream()]
+    FIRESTORE_READ_SECONDS.observe(time.perf_counter() - started, op='conversations')
+    turns.reverse()
+    if pending:
+        stored = {turn['timestamp'] for turn in turns}
+        turns.extend(turn for turn in pending if turn['timestamp'] not in stored)
+        turns.sort(key=lambda turn: turn['timestamp'])
+    return turns
+
+class HistoryCache:
+    """LRU/TTL cache of each user's most recent turns, kept current by stream_chat appends."""
+
+    def __init__(self, max_users=None, max_turns=None, ttl=None):
+        self.max_users = max_users or HISTORY_CACHE_USERS
+        self.max_turns = max_turns or HISTORY_CACHE_TURNS
+        self.ttl = ttl or HISTORY_CACHE_TTL
+        self._entries = OrderedDict()  # user_id -> (expires_at, turns oldest first, complete)
+        self._appended = {}  # user_id -> sequence number of the last append
+        self._seq = 0
+        self._pruned_at = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None: return None
+            if entry[0] < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return list(entry[1]), entry[2]
+
+    def begin_load(self, user_id):
+        with self._lock:
+            return self._seq
+
+    def put(self, user_id, turns, complete, token):
+        with self._lock:
+            # An append raced with the Firestore read; caching that read would lose the new turns.
+            if max(self._appended.get(user_id, 0), self._pruned_at) > token: return
+            self._entries[user_id] = (time.monotonic() + self.ttl, turns[-self.max_turns:], complete and len(turns) <= self.max_turns)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def append(self, user_id, turns):
+        with self._lock:
+            self._seq += 1
+            self._appended[user_id] = self._seq
+            if len(self._appended) > self.max_users * 4:
+                self._appended.clear()
+                self._pruned_at = self._seq
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                merged = entry[1] + list(turns)
+                self._entries[user_id] = (entry[0], merged[-self.max_turns:], entry[2] and len(merged) <= self.max_turns)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+history_cache = HistoryCache()
+
+def iter_all_turns(user_id, page_size=None):
+    """Yields (document id, turn) for every turn oldest first, reading one Firestore page at a time."""
+    page_size = page_size or HISTORY_EXPORT_PAGE_SIZE
+    query = get_db().collection('users').document(user_id).collection('conversations').order_by('timestamp')
+    last_doc, last_timestamp = None, None
+    while True:
+        started = time.perf_counter()
+        docs = list((query.start_after(last_doc) if last_doc is not None else query).limit(page_size).stream())
+        FIRESTORE_READ_SECONDS.observe(time.perf_counter() - started, op='conversations_export')
+        for doc in docs:
+            turn = doc.to_dict()
+            last_timestamp = turn['timestamp']
+            yield doc.id, turn
+        if len(docs) < page_size: break
+        last_doc = docs[-1]
+    # Turns still in the write-behind queue come last, unless they were committed while we read.
+    for turn in turn_writer.pending(user_id):
+        if last_timestamp is None or turn['timestamp'] > last_timestamp: yield turn_doc_id(turn), turn
+
+def turn_to_json(turn, doc_id):
+    return json.dumps({'id': doc_id, 'role': turn['role'], 'text': turn['text'], 'timestamp': turn['timestamp'].isoformat()}, ensure_ascii=False)
+
+_DOC_ID_RE = re.compile(r'(?!\.{1,2}$)(?!__.*__$)[^/]{1,1500}')
+def turn_from_json(line):
+    """Parses one NDJSON line into (document id or None, turn)."""
+    data = json.loads(line)
+    if not (isinstance(data, dict) and data.get('role') in ('user', 'model') and isinstance(data.get('text'), str)):
+        raise ValueError("role は user/model、text は文字列である必要があります")
+    doc_id = data.get('id')
+    if doc_id is not None and not (isinstance(doc_id, str) and _DOC_ID_RE.fullmatch(doc_id)):
+        raise ValueError("id が不正です")
+    timestamp = datetime.datetime.fromisoformat(data['timestamp'])
+    if timestamp.tzinfo is None: timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return doc_id, {'role': data['role'], 'text': data['text'], 'timestamp': timestamp}
+
+def export_history(user_id, compress=False):
+    """Yields the user's whole history as NDJSON (optionally gzip), one Firestore page per chunk."""
+    deflater = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    lines = []
+    for doc_id, turn in iter_all_turns(user_id):
+        lines.append(turn_to_json(turn, doc_id))
+        if len(lines) >= HISTORY_EXPORT_PAGE_SIZE:
+            data = ("\n".join(lines) + "\n").encode('utf-8')
+            lines = []
+            data = deflater.compress(data) if deflater else data
+            if data: yield data
+    data = ("\n".join(lines) + "\n").encode('utf-8') if lines else b''
+    if deflater: data = deflater.compress(data) + deflater.flush()
+    if data: yield data
+
+def import_history(user_id, stream):
+    """Reads NDJSON turns from a binary stream and commits them in batches. Returns (imported, errors).
+
+    Each turn keeps the document id it was exported with, or gets a content-derived one (turn_doc_id) when the
+    line has none, so re-importing an export does not duplicate turns.
+    """
+    imported, errors, batch, doc_ids, oldest = 0, [], [], [], None
+    def flush():
+        nonlocal imported, oldest
+        if batch and not turn_writer.write_now(user_id, batch, doc_ids):
+            raise RuntimeError(f"{imported}件を保存した後に書き込みに失敗しました")
+        imported += len(batch)
+        oldest = min([t['timestamp'] for t in batch] + ([oldest] if oldest else []), default=None)
+        batch.clear(); doc_ids.clear()
+    line_no = 0
+    try:
+        while True:
+            line = stream.readline(HISTORY_IMPORT_MAX_LINE_BYTES + 1)
+            if not line: break
+            line_no += 1
+            try:
+                if len(line) > HISTORY_IMPORT_MAX_LINE_BYTES:
+                    while line and not line.endswith(b'\n'): line = stream.readline(HISTORY_IMPORT_MAX_LINE_BYTES)
+                    raise ValueError("行が長すぎます")
+                if not line.strip(): continue
+                doc_id, turn = turn_from_json(line)
+            except (ValueError, KeyError, TypeError) as e:
+                if len(errors) < 100: errors.append({'line': line_no, 'error': str(e)})
+                continue
+            batch.append(turn)
+            doc_ids.append(doc_id)
+            if len(batch) >= turn_writer.batch_size: flush()
+        flush()
+    finally:
+        if imported:
+            history_cache.invalidate(user_id)
+            # Turns older than what the rolling summary covers would never be folded in; only then rebuild it.
+            user_ref = get_db().collection('users').document(user_id)
+            summarized_until = (user_ref.get().to_dict() or {}).get('context_summary_until')
+            if summarized_until and oldest <= summarized_until:
+                user_ref.set({'context_summary': '', 'context_summary_until': None}, merge=True)
+    return imported, errors
+
+def get_recent_history(user_id):
+    """Returns (latest turns oldest first, whether that is the user's entire history)."""
+    cached = history_cache.get(user_id)
+    if cached is not None: return cached
+    token = history_cache.begin_load(user_id)
+    turns = fetch_turns(user_id, HISTORY_CACHE_TURNS)
+    complete = len(turns) < HISTORY_CACHE_TURNS
+    history_cache.put(user_id, turns, complete, token)
+    return turns, complete
+
+def fetch_tied_turns(user_id, timestamp, limit):
+    """Reads every turn stored at exactly `timestamp`."""
+    while True:
+        turns = fetch_turns(user_id, limit, before=timestamp + datetime.timedelta(microseconds=1))
+        if len(turns) < limit or turns[0]['timestamp'] < timestamp:
+            return [t for t in turns if t['timestamp'] == timestamp]
+        limit *= 2
+
+def get_history_page(user_id, limit, before=None):
+    """Returns (about `limit` turns older than `before`, oldest first, and whether older turns exist).
+
+    The next page starts strictly before this page's oldest timestamp, so a page never ends inside a run
+    of equal timestamps (imported turns often share a second): it grows to take the whole run instead.
+    """
+    turns, complete = get_recent_history(user_id)
+    candidates = [t for t in turns if before is None or t['timestamp'] < before]
+    if not (len(candidates) > limit or complete):
+        candidates = fetch_turns(user_id, limit + 1, before)
+        complete = len(candidates) <= limit
+    page, older = candidates[-limit:], candidates[:-limit]
+    if older and older[-1]['timestamp'] == page[0]['timestamp']:
+        boundary = page[0]['timestamp']
+        if complete or candidates[0]['timestamp'] < boundary:
+            tied = [t for t in candidates if t['timestamp'] == boundary]
+        else:
+            tied = fetch_tied_turns(user_id, boundary, limit + 1)
+        page = tied + [t for t in page if t['timestamp'] != boundary]
+        older = [t for t in older if t['timestamp'] < boundary]
+        return page, bool(older) or not complete
+    return page, bool(older)
+
+# --- 7. Conversation Context ---
+def estimate_tokens(text):
+    # Rough Gemini token estimate: ~4 ASCII characters per token, ~1 per Japanese character.
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+def format_history(summary, turns):
+    parts = []
+    if summary:
+        parts.append(f"(これまでの会話の要約)\n{summary}")
+    if turns:
+        parts.append("\n".join(f"{'User' if t['role'] == 'user' else 'AI'}: {t['text']}" for t in turns))
+    return "\n\n".join(parts)
+
+def split_context_window(turns, budget=None, max_turns=None):
+    # turns are oldest first; keep the newest ones that fit the token budget and turn cap verbatim.
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    max_turns = max_turns or CONTEXT_WINDOW_TURNS
+    used = 0
+    for i in range(len(turns) - 1, -1, -1):
+        used += estimate_tokens(turns[i]['text'])
+        if used > budget or len(turns) - i > max_turns:
+            return turns[:i + 1], turns[i + 1:]
+    return [], turns
+
+def load_conversation_context(user_id):
+    """Returns (summary, recent turns kept verbatim, older turns not yet folded into the summary, gap).
+
+    gap is (summarized until, start of the cached tail) when unsummarized turns exist before the cached
+    tail; the newest CONTEXT_CATCH_UP_TURNS of them are folded in the background rather than read on the
+    request path.
+    """
+    started = time.perf_counter()
+    state = get_db().collection('users').document(user_id).get().to_dict() or {}
+    FIRESTORE_READ_SECONDS.observe(time.perf_counter() - started, op='user_state')
+    summary = state.get('context_summary', '')
+    summarized_until = state.get('context_summary_until')
+    turns, complete = get_recent_history(user_id)
+    unsummarized = [t for t in turns if not (summarized_until and t['timestamp'] <= summarized_until)]
+    older, recent = split_context_window(unsummarized)
+    gap = None
+    if turns and not complete and len(unsummarized) == len(turns):
+        gap = (summarized_until, turns[0]['timestamp'])
+    return summary, recent, older, gap
+
+def summarize_into(user_id, summary, turns):
+    prompt = (f"以下は会話のこれまでの要約と、その続きの会話です。重要な事実、ユーザーの意図、決定事項を残し、"
+              f"{CONTEXT_SUMMARY_CHARS}文字以内の新しい要約を日本語で作成してください。\n"
+              f"--- これまでの要約 ---\n{summary or '(なし)'}\n--- 続きの会話 ---\n{format_history('', turns)}")
+    summary_turn = ChatTurn(user_id, '', CONTEXT_SUMMARY_MODEL, 0, '', False)
+    new_summary = run_admitted(summary_turn, BACKGROUND_PRIORITY,
+                               lambda: get_model(CONTEXT_SUMMARY_MODEL).generate_content(prompt).text.strip())
+    # Saved after every call, so an interrupted catch-up resumes where it stopped.
+    get_db().collection('users').document(user_id).set(
+        {'context_summary': new_summary, 'context_summary_until': turns[-1]['timestamp']}, merge=True)
+    return new_summary
+
+summarizing_users = set()
+summarizing_lock = threading.Lock()
+def fold_into_summary(user_id, summary, turns, gap=None):
+    # Runs off the request path: the previous summary plus the turns that just left the window
+    # are condensed into the new summary, so each update costs O(evicted turns), not O(history).
+    # A gap before the cached tail (history that predates any summary) is caught up once, page by page,
+    # from a bounded tail: the summary then starts there and anything older is left out of it.
+    with summarizing_lock:
+        if user_id in summarizing_users: return
+        summarizing_users.add(user_id)
+    try:
+        if not get_genai(): return
+        if gap is not None:
+            after, before = gap
+            tail = [t for t in fetch_turns(user_id, CONTEXT_CATCH_UP_TURNS, before=before) if not (after and t['timestamp'] <= after)]
+            for i in range(0, len(tail), CONTEXT_MAX_TURNS):
+                summary = summarize_into(user_id, summary, tail[i:i + CONTEXT_MAX_TURNS])
+        for i in range(0, len(turns), CONTEXT_MAX_TURNS):
+            summary = summarize_into(user_id, summary, turns[i:i + CONTEXT_MAX_TURNS])
+    except Exception as e:
+        print(f"Error updating conversation summary for user {user_id}: {e}")
+    finally:
+        with summarizing_lock:
+            summarizing_users.discard(user_id)
+
+# --- 8. Write-Behind Turn Persistence ---
+def turn_doc_id(turn):
+    # Content-derived, so a turn always lands on the same document whether written live or re-imported.
+    timestamp = turn['timestamp'].astimezone(datetime.timezone.utc).isoformat()
+    return hashlib.sha256(f"{timestamp}\0{turn['role']}\0{turn['text']}".encode('utf-8')).hexdigest()
+
+class TurnWriter:
+    """Queues conversation turns and commits them to Firestore in batches from a background thread."""
+
+    def __init__(self, db_getter=get_db, batch_size=None, flush_interval=None, max_queue=None, max_retries=None):
+        self.db_getter = db_getter
+        self.batch_size = min(batch_size or PERSIST_BATCH_SIZE, 500)  # Firestore's per-batch write limit
+        self.flush_interval = flush_interval or PERSIST_FLUSH_INTERVAL
+        self.max_retries = max_retries if max_retries is not None else PERSIST_MAX_RETRIES
+        self._queue = queue.Queue(maxsize=max_queue or PERSIST_QUEUE_SIZE)
+        self._pending = {}  # user_id -> turns queued but not yet committed, for read-your-writes
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def enqueue(self, user_id, turns):
+        with self._lock:
+            self._pending.setdefault(user_id, []).extend(turns)
+            if self._thread is None and not self._stopping.is_set():
+                self._thread = threading.Thread(target=self._run, name='turn-writer', daemon=True)
+                self._thread.start()
+        if self._stopping.is_set():
+            # Generations outlive their clients, so turns can still arrive after shutdown began: write them here.
+            self._commit([(user_id, turns)])
+            return
+        try:
+            self._queue.put((user_id, turns), timeout=PERSIST_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            # Backpressure: the writer is far behind, so pay for the write on this thread instead of dropping it.
+            self._commit([(user_id, turns)])
+        if self._stopping.is_set():
+            self._commit_queued()  # close() may have finished draining just before the put
+
+    def pending(self, user_id):
+        with self._lock:
+            return list(self._pending.get(user_id, ()))
+
+    def write_now(self, user_id, turns, doc_ids=None):
+        """Commits turns on this thread, in Firestore-sized batches (bulk import). A None id means turn_doc_id."""
+        for i in range(0, len(turns), self.batch_size):
+            if not self._commit([(user_id, turns[i:i + self.batch_size])], doc_ids and doc_ids[i:i + self.batch_size]): return False
+        return True
+
+    def close(self, timeout=10):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._commit_queued()
+
+    def _commit_queued(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._commit([item])
+
+    def _run(self):
+        while True:
+            items = self._drain()
+            if items:
+                self._commit(items)
+            elif self._stopping.is_set():
+                return
+
+    def _drain(self):
+        # Flush when the batch is full or flush_interval after its first turn arrived, whichever comes first.
+        try:
+            items = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        ops = len(items[0][1])
+        deadline = time.monotonic() + self.flush_interval
+        while ops < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 and not self._stopping.is_set() else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            items.append(item)
+            ops += len(item[1])
+        return items
+
+    def _commit(self, items, doc_ids=None):
+        committed = False
+        for attempt in range(self.max_retries + 1):
+            try:
+                started = time.perf_counter()
+                db = self.db_getter()
+                batch = db.batch()
+                for user_id, turns in items:
+                    convo_ref = db.collection('users').document(user_id).collection('conversations')
+                    for i, turn in enumerate(turns):
+                        batch.set(convo_ref.document((doc_ids and doc_ids[i]) or turn_doc_id(turn)), turn)
+                batch.commit()
+                FIRESTORE_WRITE_SECONDS.observe(time.perf_counter() - started, op='turn_batch')
+                TURNS_PERSISTED.inc(sum(len(turns) for _, turns in items))
+                committed = True
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    print(f"Error persisting {sum(len(t) for _, t in items)} turns, giving up: {e}")
+                    break
+                time.sleep(min(0.2 * 2 ** attempt, 5))
+        with self._lock:
+            for user_id, turns in items:
+                pending = self._pending.get(user_id, [])
+                for turn in turns:
+                    if turn in pending: pending.remove(turn)
+                if not pending: self._pending.pop(user_id, None)
+        return committed
+
+turn_writer = TurnWriter()
+TURNS_PERSISTED = MetricCounter('turn_writer_turns_persisted_total', 'Conversation turns committed by the write-behind writer.')
+GaugeCallback('turn_writer_queue_depth', 'Turn batches waiting in the write-behind queue.', lambda: [({}, turn_writer._queue.qsize())])
+atexit.register(turn_writer.close)
+
+# --- 9. Response Cache ---
+def response_cache_key(model_name, temperature, system_instruction, final_prompt):
+    payload = json.dumps([model_name, temperature, system_instruction, final_prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def response_cacheable(is_deep_think, temperature):
+    if not RESPONSE_CACHE_ENABLED: return False
+    if is_deep_think: return RESPONSE_CACHE_DEEP_THINK
+    return temperature <= RESPONSE_CACHE_MAX_TEMPERATURE
+
+class ResponseCache:
+    """LRU/TTL cache of finished answers, bounded by total characters, with an optional SQLite backing store."""
+
+    def __init__(self, max_chars=None, ttl=None, path=None):
+        self.max_chars = max_chars or RESPONSE_CACHE_MAX_CHARS
+        self.ttl = ttl or RESPONSE_CACHE_TTL
+        self._entries = OrderedDict()  # key -> (expires_at wall clock, text)
+        self._chars = 0
+        self._lock = threading.Lock()
+        self.stats = Counter()
+        self._disk = None
+        path = path or RESPONSE_CACHE_PATH
+        if path:
+            import sqlite3
+            self._disk = sqlite3.connect(path, check_same_thread=False)
+            self._disk.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT, expires_at REAL)')
+            self._disk.execute('DELETE FROM responses WHERE expires_at < ?', (time.time(),))
+            self._disk.commit()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None and self._disk is not None:
+                row = self._disk.execute('SELECT expires_at, text FROM responses WHERE key = ? AND expires_at >= ?', (key, time.time())).fetchone()
+                if row is not None:
+                    self.stats['disk_hits'] += 1
+                    entry = row
+                    self._insert(key, entry)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, text):
+        if len(text) > self.max_chars: return
+        entry = (time.time() + self.ttl, text)
+        with self._lock:
+            self._insert(key, entry)
+            self.stats['stores'] += 1
+            if self._disk is not None:
+                self._disk.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, text, entry[0]))
+                if self.stats['stores'] % 100 == 0:
+                    self._disk.execute('DELETE FROM responses WHERE expires_at < ?', (time.time(),))
+                self._disk.commit()
+
+    def _insert(self, key, entry):
+        if key in self._entries: self._remove(key)
+        self._entries[key] = entry
+        self._chars += len(entry[1])
+        while self._chars > self.max_chars:
+            self._remove(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        self._chars -= len(self._entries.pop(key)[1])
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), chars=self._chars, enabled=RESPONSE_CACHE_ENABLED)
+
+response_cache = ResponseCache()
+GaugeCallback('response_cache_events_total', 'Response cache lookups and maintenance events.',
+              lambda: [({'event': k}, v) for k, v in sorted(response_cache.stats.items())], metric_type='counter')
+GaugeCallback('response_cache_chars', 'Characters held in the in-memory response cache.', lambda: [({}, response_cache._chars)])
+
+# --- 10. Chat Generation Pipeline ---
+DEEP_THINK_SYSTEM_INSTRUCTION = "あなたは非常に慎重で論理的な専門家です。ユーザーの質問に対して、まず背景、複数の視点、そして段階的な思考プロセスを内部で整理してください。その上で、最も論理的で包括的な回答を生成してください。"
+
+class ChatTurn:
+    """Everything resolved for one /stream_chat request before the model is called."""
+
+    def __init__(self, user_id, user_prompt, model_name, temperature, system_instruction, is_deep_think):
+        self.user_id = user_id
+        self.user_prompt = user_prompt
+        self.model_name = model_name
+        self.temperature = temperature
+        self.system_instruction = system_instruction
+        self.is_deep_think = is_deep_think
+        self.final_prompt = user_prompt
+        self.flight_key = None
+        self.cache_key = None
+        self.cached_response = None
+        self.summary = ''
+        self.recent_turns = []
+        self.unsummarized_turns = []
+        self.summary_gap = None
+        self.holds_slot = False  # an upstream scheduler slot for model_name is held for this turn
+        self.timings = {}
+
+    def metric_labels(self):
+        return {'model': self.model_name, 'deep_think': 'true' if self.is_deep_think else 'false'}
+
+def prepare_chat(data, user_id):
+    """Resolves settings, context and cache for a chat request. Returns (turn, error message)."""
+    started = time.perf_counter()
+    user_prompt = data.get('prompt', "")
+
+    is_deep_think = data.get('deep_think_mode', False)
+    if is_deep_think:
+        turn = ChatTurn(user_id, user_prompt, 'gemini-2.5-pro', 0.5, DEEP_THINK_SYSTEM_INSTRUCTION, True)
+    else:
+        turn = ChatTurn(user_id, user_prompt, data.get('model_name', 'gemini-1.5-flash'),
+                        float(data.get('temperature', 1.0)), data.get('system_instruction', ""), False)
 
-# --- 4. HTML Template ---
+    # ▼▼▼ BUG FIX: Use the get_genai() function to get the client ▼▼▼
+    if not (get_genai() and user_prompt):
+        return None, "エラー: GEMINI_API_KEYが設定されていないか、プロンプトが空です。"
+
+    if user_id:
+        retry_after = user_rate_limiter.take(user_id)
+        if retry_after:
+            UPSTREAM_REJECTED.inc(reason='rate_limited', **turn.metric_labels())
+            return None, f"リクエストが多すぎます。{math.ceil(retry_after)}秒後にもう一度お試しください。"
+
+    # Files are referenced by hash; older clients still inline them, which is indexed ad hoc.
+    knowledge_refs = data.get('knowledge', [])
+    knowledge_files = data.get('knowledge_files', [])
+    if knowledge_refs:
+        if not (isinstance(knowledge_refs, list) and len(knowledge_refs) <= KNOWLEDGE_MAX_FILES and all(
+                isinstance(ref, dict) and isinstance(ref.get('name'), str) and SHA256_RE.match(str(ref.get('sha256', '')))
+                for ref in knowledge_refs)):
+            return None, "エラー: 知識ファイルの指定が正しくありません。"
+        index = get_knowledge_index((ref['name'], ref['sha256']) for ref in knowledge_refs)
+    elif knowledge_files:
+        index = KnowledgeIndex((f['name'], f['content']) for f in knowledge_files)
+    else:
+        index = None
+    knowledge_chunks = index.search(user_prompt) if index else []
+
+    # Logged-in history comes from the stored conversation, not from the client.
+    if user_id:
+        turn.summary, turn.recent_turns, turn.unsummarized_turns, turn.summary_gap = load_conversation_context(user_id)
+        history_text = format_history(turn.summary, turn.recent_turns)
+    else:
+        history_text = data.get('history_text', '')
+    turn.final_prompt = build_final_prompt(user_prompt, knowledge_chunks, history_text)
+
+    turn.flight_key = response_cache_key(turn.model_name, turn.temperature, turn.system_instruction, turn.final_prompt)
+    if response_cacheable(is_deep_think, turn.temperature):
+        turn.cache_key = turn.flight_key
+        turn.cached_response = response_cache.get(turn.cache_key)
+    turn.timings['assembly'] = time.perf_counter() - started
+    PROMPT_ASSEMBLY_SECONDS.observe(turn.timings['assembly'], **turn.metric_labels())
+    return turn, None
+
+def build_chat_session(turn):
+    return get_model(turn.model_name, turn.temperature, turn.system_instruction).start_chat(history=[])
+
+async def astream_model(turn):
+    timer = StreamTimer(turn)
+    response_stream = await build_chat_session(turn).send_message_async(turn.final_prompt, stream=True)
+    async for chunk in response_stream:
+        if chunk.text:
+            timer.chunk(chunk.text)
+            yield chunk.text
+    timer.finish()
+
+async def hedged_stream(turn):
+    """astream_model with a first-chunk latency budget; the hedge holds its own scheduler slot.
+
+    Whichever racer loses gives its slot back as soon as it is discarded; if that is the primary,
+    turn.holds_slot is cleared so the caller does not release it a second time.
+    """
+    started = time.perf_counter()
+    budget = HEDGE_BUDGETS_MS.get(turn.model_name)
+    primary = astream_model(turn).__aiter__()
+    first = asyncio.ensure_future(primary.__anext__())
+    racers = {first: primary}
+    slots = {}  # hedge task -> model whose slot it holds
+    hedge_model = None
+    try:
+        if budget:
+            await asyncio.wait({first}, timeout=budget / 1000)
+        if budget and not first.done():
+            hedge_model = HEDGE_FALLBACK_MODELS.get(turn.model_name, turn.model_name)
+            labels = dict(turn.metric_labels(), hedge_model=hedge_model)
+            if upstream_scheduler.try_acquire(hedge_model):
+                HEDGE_EVENTS.inc(event='fired', **labels)
+                hedge_turn = copy.copy(turn)
+                hedge_turn.model_name = hedge_model
+                hedge = astream_model(hedge_turn).__aiter__()
+                task = asyncio.ensure_future(hedge.__anext__())
+                racers[task], slots[task] = hedge, hedge_model
+            else:
+                HEDGE_EVENTS.inc(event='skipped', **labels)
+                hedge_model = None
+        # The first racer to produce a chunk (or finish cleanly) wins; a failed racer only loses if another is left.
+        pending = set(racers)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if not task.exception() or isinstance(task.exception(), StopAsyncIteration)), None)
+            if winner is not None or not pending: break
+        if winner is None: winner = first
+        for task in list(racers):
+            if task is winner: continue
+            slot_model = slots.pop(task, None)
+            if task is first and turn.holds_slot:
+                turn.holds_slot, slot_model = False, turn.model_name
+            await discard_racer(task, racers.pop(task), slot_model)
+        if hedge_model:
+            won = winner is not first
+            HEDGE_EVENTS.inc(event='won' if won else 'lost', **labels)
+            turn.timings['hedge'] = 'won' if won else 'lost'
+            # A fallback model's answer must not be cached as the primary model's.
+            if won and hedge_model != turn.model_name: turn.cache_key = None
+        try:
+            text = winner.result()
+        except StopAsyncIteration:
+            return
+        turn.timings['first_chunk'] = time.perf_counter() - started
+        TIME_TO_FIRST_CHUNK_SECONDS.observe(turn.timings['first_chunk'], **turn.metric_labels())
+        yield text
+        async for text in racers[winner]:
+            yield text
+    finally:
+        for task, racer in racers.items():
+            await discard_racer(task, racer, slots.pop(task, None))
+
+async def discard_racer(task, racer, slot_model=None):
+    try:
+        if not task.done():
+            task.cancel()
+        try:
+            await task
+        except BaseException:
+            pass
+        await racer.aclose()
+    finally:
+        if slot_model: upstream_scheduler.release(slot_model)
+
+def replay_cached(turn):
+    text = turn.cached_response
+    for i in range(0, len(text), RESPONSE_CACHE_REPLAY_CHARS):
+        yield text[i:i + RESPONSE_CACHE_REPLAY_CHARS]
+
+def finish_chat(turn, full_ai_response):
+    if METRICS_LOG_TIMINGS:
+        timings = ' '.join(f"{k}={v * 1000:.1f}ms" if isinstance(v, float) else f"{k}={v}" for k, v in turn.timings.items())
+        print(f"chat timing model={turn.model_name} deep_think={turn.is_deep_think} cached={turn.cached_response is not None} {timings}")
+    if turn.cache_key and turn.cached_response is None and full_ai_response:
+        response_cache.put(turn.cache_key, full_ai_response)
+    if turn.user_id:
+        utc_now = datetime.datetime.now(datetime.timezone.utc)
+        new_turns = [{'role': 'user', 'text': turn.user_prompt, 'timestamp': utc_now},
+                     {'role': 'model', 'text': full_ai_response, 'timestamp': utc_now + datetime.timedelta(microseconds=1)}]
+        turn_writer.enqueue(turn.user_id, new_turns)
+        history_cache.append(turn.user_id, new_turns)
+        # Fold whatever the new turns push out of the window now, so the next prompt never has a gap.
+        evicted, _ = split_context_window(turn.recent_turns + new_turns)
+        if turn.unsummarized_turns or evicted or turn.summary_gap:
+            threading.Thread(target=fold_into_summary, args=(turn.user_id, turn.summary, turn.unsummarized_turns + evicted, turn.summary_gap), daemon=True).start()
+
+# --- 11. Upstream Admission Control ---
+class TokenBucketLimiter:
+    """Per-key token buckets; full buckets are forgotten, so idle users cost nothing."""
+
+    def __init__(self, rate_per_minute=None, burst=None):
+        self.rate = (USER_RATE_PER_MINUTE if rate_per_minute is None else rate_per_minute) / 60.0  # 0 disables
+        self.burst = burst or USER_RATE_BURST
+        self._buckets = {}  # key -> (tokens, monotonic time of last update)
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Takes one token. Returns 0 when allowed, otherwise the seconds until a token is available."""
+        if self.rate <= 0: return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > 10000:
+                self._buckets = {k: v for k, v in self._buckets.items() if v[0] + (now - v[1]) * self.rate < self.burst}
+            return 0
+
+class SchedulerRejected(Exception):
+    """The upstream call was not admitted; the message is shown to the user."""
+
+QUEUE_FULL_MESSAGE = "現在混み合っています。しばらくしてからもう一度お試しください。"
+
+class UpstreamScheduler:
+    """Admits Gemini calls under per-model and total concurrency limits.
+
+    Lives on the upstream loop. Callers that cannot start at once wait in a bounded queue ordered by
+    priority (interactive models, then Deep Think, then background work) and arrival; a full queue rejects
+    immediately.
+    """
+
+    def __init__(self, limits=None, default_limit=None, max_total=None, max_queue=None, queue_timeout=None):
+        self.limits = MODEL_CONCURRENCY if limits is None else limits
+        self.default_limit = default_limit or MODEL_CONCURRENCY_DEFAULT
+        self.max_total = max_total or UPSTREAM_MAX_CONCURRENCY
+        self.max_queue = UPSTREAM_QUEUE_SIZE if max_queue is None else max_queue
+        self.queue_timeout = queue_timeout or UPSTREAM_QUEUE_TIMEOUT
+        self.active = Counter()
+        self._waiting = []  # [priority, seq, model, future]; sorted when admitting
+        self._seq = 0
+
+    def _has_room(self, model):
+        return sum(self.active.values()) < self.max_total and self.active[model] < self.limits.get(model, self.default_limit)
+
+    async def acquire(self, turn, priority=None):
+        model, labels = turn.model_name, turn.metric_labels()
+        started = time.perf_counter()
+        if not self._waiting and self._has_room(model):
+            self.active[model] += 1
+            UPSTREAM_QUEUE_WAIT_SECONDS.observe(0, **labels)
+            return
+        if priority is None: priority = 1 if turn.is_deep_think else 0
+        if len(self._waiting) >= self.max_queue:
+            # A full queue still takes interactive requests by turning away the newest Deep Think waiter.
+            victim = max(self._waiting, default=None)
+            if victim is None or victim[0] <= priority:
+                UPSTREAM_REJECTED.inc(reason='queue_full', **labels)
+                raise SchedulerRejected(QUEUE_FULL_MESSAGE)
+            self._waiting.remove(victim)
+            victim[3].set_exception(SchedulerRejected(QUEUE_FULL_MESSAGE))
+            UPSTREAM_REJECTED.inc(reason='displaced', model=victim[2], deep_think='true' if victim[0] == 1 else 'false')
+        self._seq += 1
+        entry = [priority, self._seq, model, asyncio.get_running_loop().create_future()]
+        self._waiting.append(entry)
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[3]), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if entry[3].done():
+                self.release(model)  # admitted just as the wait gave up
+            else:
+                entry[3].cancel()
+                self._waiting.remove(entry)
+            if isinstance(e, asyncio.CancelledError): raise
+            UPSTREAM_REJECTED.inc(reason='timeout', **labels)
+            raise SchedulerRejected("待ち時間が上限を超えました。しばらくしてからもう一度お試しください。")
+        finally:
+            UPSTREAM_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started, **labels)
+
+    def release(self, model):
+        self.active[model] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        # Admit waiters in priority order; one blocked on its model's limit does not hold up other models.
+        for entry in sorted(self._waiting):
+            if not self._has_room(entry[2]): continue
+            self._waiting.remove(entry)
+            self.active[entry[2]] += 1
+            entry[3].set_result(None)
+
+    def try_acquire(self, model):
+        # For hedges: take a free slot now or not at all, never ahead of queued callers.
+        if self._waiting or not self._has_room(model): return False
+        self.active[model] += 1
+        return True
+
+    def queue_depth(self):
+        return Counter(entry[2] for entry in self._waiting)
+
+user_rate_limiter = TokenBucketLimiter()
+upstream_scheduler = UpstreamScheduler()
+BACKGROUND_PRIORITY = 2  # summary folding: admitted after every waiting chat request, displaced first
+
+def run_admitted(turn, priority, call):
+    # For blocking calls made off the upstream loop (e.g. summary folding): hold a scheduler slot around call().
+    loop = get_upstream_loop()
+    asyncio.run_coroutine_threadsafe(upstream_scheduler.acquire(turn, priority), loop).result()
+    try:
+        return call()
+    finally:
+        loop.call_soon_threadsafe(upstream_scheduler.release, turn.model_name)
+UPSTREAM_QUEUE_WAIT_SECONDS = Histogram('upstream_queue_wait_seconds', 'Time a generation waited for an upstream slot.')
+UPSTREAM_REJECTED = MetricCounter('upstream_rejected_total', 'Chat requests turned away by rate limiting or admission control.')
+HEDGE_EVENTS = MetricCounter('chat_hedge_events_total', 'Hedged requests after a missed first-chunk budget: fired, won, lost, or skipped for lack of a slot.')
+GaugeCallback('upstream_queue_depth', 'Generations waiting for an upstream slot.',
+              lambda: [({'model': model}, count) for model, count in sorted(upstream_scheduler.queue_depth().items())])
+GaugeCallback('upstream_active_calls', 'Gemini calls currently admitted.',
+              lambda: [({'model': model}, count) for model, count in sorted(upstream_scheduler.active.items())])
+
+# --- 12. Resumable Streams ---
+# Every generation runs as a task on one background event loop and writes into a GenerationStream.
+# Responses only follow that buffer, so a dropped connection can reconnect with Last-Event-ID while
+# the upstream call carries on, and no thread is tied to an upstream stream.
+upstream_loop = None
+upstream_loop_lock = threading.Lock()
+def get_upstream_loop():
+    global upstream_loop
+    with upstream_loop_lock:
+        if upstream_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='upstream-loop', daemon=True).start()
+            upstream_loop = loop
+    return upstream_loop
+
+class StreamGap(Exception):
+    """The chunks after the client's Last-Event-ID have already left the ring buffer."""
+
+class GenerationStream:
+    """Chunks of one answer, with a ring buffer for resumption and wake-ups for sync and async readers."""
+
+    def __init__(self, user_id):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.text = ""  # full answer, needed for persistence; released once persisted
+        self.ring = deque(maxlen=STREAM_RING_CHUNKS)  # (seq, text)
+        self.ring_chars = 0
+        self.last_seq = 0
+        self.done = False
+        self.error = None
+        self.touched = time.monotonic()
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def append(self, text):
+        with self._cond:
+            if len(self.ring) == self.ring.maxlen:
+                self.ring_chars -= len(self.ring[0][1])
+            self.last_seq += 1
+            self.ring.append((self.last_seq, text))
+            self.ring_chars += len(text)
+            self.text += text
+            self._wake()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self.touched = time.monotonic()
+            self._wake()
+
+    def memory_chars(self):
+        return self.ring_chars + len(self.text)
+
+    def _wake(self):
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    def _since(self, after):
+        # Caller holds the lock. Returns the buffered chunks newer than `after`.
+        self.touched = time.monotonic()
+        if after >= self.last_seq: return []
+        if self.ring and after < self.ring[0][0] - 1: raise StreamGap()
+        return [chunk for chunk in self.ring if chunk[0] > after]
+
+    def follow(self, after=0, heartbeat=None):
+        """Yields (seq, text) from `after` onwards until the answer is done; yields None on idle heartbeats."""
+        heartbeat = heartbeat or STREAM_HEARTBEAT
+        while True:
+            with self._cond:
+                chunks = self._since(after)
+                if not chunks and not self.done:
+                    self._cond.wait(heartbeat)
+                    chunks = self._since(after)
+                done = self.done
+            for chunk in chunks:
+                yield chunk
+                after = chunk[0]
+            if not chunks:
+                if done: return
+                yield None
+
+    async def afollow(self, after=0, heartbeat=None):
+        heartbeat = heartbeat or STREAM_HEARTBEAT
+        loop = asyncio.get_running_loop()
+        while True:
+            future = None
+            with self._cond:
+                chunks = self._since(after)
+                done = self.done
+                if not chunks and not done:
+                    future = loop.create_future()
+                    self._async_waiters.append((loop, future))
+            if future is not None:
+                try:
+                    await asyncio.wait_for(future, heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                continue
+            for chunk in chunks:
+                yield chunk
+                after = chunk[0]
+            if not chunks and done: return
+
+class StreamRegistry:
+    """Live and recently finished streams, evicted by idle TTL and a total memory cap."""
+
+    def __init__(self, ttl=None, max_chars=None):
+        self.ttl = ttl or STREAM_TTL
+        self.max_chars = max_chars or STREAM_MEMORY_CHARS
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, stream):
+        with self._lock:
+            self._streams[stream.id] = stream
+            self._evict()
+
+    def get(self, stream_id):
+        with self._lock:
+            self._evict()
+            return self._streams.get(stream_id)
+
+    def _evict(self):
+        now = time.monotonic()
+        for stream_id, stream in list(self._streams.items()):
+            if stream.done and now - stream.touched > self.ttl:
+                del self._streams[stream_id]
+        # Over the memory cap: drop finished streams first, oldest first; live ones are bounded by their ring.
+        total = sum(stream.memory_chars() for stream in self._streams.values())
+        for stream_id, stream in list(self._streams.items()):
+            if total <= self.max_chars: break
+            if stream.done:
+                total -= stream.memory_chars()
+                del self._streams[stream_id]
+
+    def __len__(self):
+        return len(self._streams)
+
+stream_registry = StreamRegistry()
+GaugeCallback('chat_streams_buffered', 'Generation streams held for resumption.', lambda: [({}, len(stream_registry))])
+
+class SingleFlight:
+    """Streams currently calling the model, by generation inputs, so identical requests can attach to them."""
+
+    def __init__(self):
+        self._leaders = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, stream):
+        # Returns the stream already generating `key`, or None after making `stream` its leader.
+        with self._lock:
+            leader = self._leaders.get(key)
+            if leader is not None and not leader.done: return leader
+            self._leaders[key] = stream
+            return None
+
+    def leave(self, key, stream):
+        with self._lock:
+            if self._leaders.get(key) is stream: del self._leaders[key]
+
+    def __len__(self):
+        return len(self._leaders)
+
+single_flight = SingleFlight()
+COALESCED_GENERATIONS = MetricCounter('chat_coalesced_total', 'Chat requests served by attaching to an identical in-flight generation.')
+GaugeCallback('chat_single_flight_leaders', 'Generations that identical requests can currently attach to.', lambda: [({}, len(single_flight))])
+
+class LeaderFailed(Exception):
+    """The generation a request attached to ended with an error; carries the leader's message."""
+
+async def relay_leader(leader, stream):
+    # Late joiners first get everything generated so far as one chunk, then follow the leader live.
+    with leader._cond:
+        prefix, after = leader.text, leader.last_seq
+    if prefix: stream.append(prefix)
+    async for chunk in leader.afollow(after):
+        if chunk is not None: stream.append(chunk[1])
+    if leader.error: raise LeaderFailed(leader.error)
+
+async def run_generation(stream, turn):
+    try:
+        if turn.cached_response is not None:
+            for text in replay_cached(turn):
+                stream.append(text)
+        else:
+            leader = single_flight.join(turn.flight_key, stream) if SINGLE_FLIGHT_ENABLED else None
+            if leader is not None:
+                COALESCED_GENERATIONS.inc(**turn.metric_labels())
+                await relay_leader(leader, stream)
+            else:
+                try:
+                    await upstream_scheduler.acquire(turn)
+                    turn.holds_slot = True
+                    try:
+                        async for text in hedged_stream(turn):
+                            stream.append(text)
+                    finally:
+                        # A primary that lost a hedge race has already given its slot back.
+                        if turn.holds_slot: upstream_scheduler.release(turn.model_name)
+                        turn.holds_slot = False
+                finally:
+                    single_flight.leave(turn.flight_key, stream)
+        # Persist before signalling completion, so the user's next message already sees this turn.
+        await asyncio.to_thread(finish_chat, turn, stream.text)
+        stream.finish()
+    except (LeaderFailed, SchedulerRejected) as e:
+        stream.finish(error=str(e))
+    except Exception as e:
+        print(f"Error during generation: {e}")
+        stream.finish(error=f"API呼び出し中にエラーが発生しました: {e}")
+    stream.text = ""
+
+def start_generation(turn):
+    stream = GenerationStream(turn.user_id)
+    stream_registry.add(stream)
+    asyncio.run_coroutine_threadsafe(run_generation(stream, turn), get_upstream_loop())
+    return stream
+
+def sse_event(data, event=None, event_id=None):
+    lines = []
+    if event: lines.append(f"event: {event}")
+    if event_id is not None: lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+def sse_chunk(chunk):
+    # A (seq, text) chunk, or a keep-alive comment while the upstream is quiet.
+    if chunk is None: return ": keep-alive\n\n"
+    return sse_event(chunk[1], event_id=chunk[0])
+
+def sse_end(stream):
+    return sse_event(stream.error, event='error') if stream.error else sse_event({'stream_id': stream.id}, event='done')
+
+def sse_stream(stream, after):
+    if after == 0: yield sse_event({'stream_id': stream.id}, event='stream')
+    try:
+        for chunk in stream.follow(after):
+            yield sse_chunk(chunk)
+    except StreamGap:
+        yield sse_event("再開できる範囲を超えました。もう一度送信してください。", event='error')
+        return
+    yield sse_end(stream)
+
+def parse_last_event_id(value):
+    try:
+        return max(0, int(value or 0))
+    except ValueError:
+        return 0
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# --- 13. Static Assets ---
+# CSS and JS are served under content-hashed names with far-future caching and precompressed variants.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+class StaticAsset:
+    def __init__(self, name, body):
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        stem, ext = os.path.splitext(name)
+        self.url_name = f"{stem}.{self.etag}{ext}"
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.variants = {'identity': body, 'gzip': gzip.compress(body, 9)}
+        try:
+            import brotli
+            self.variants['br'] = brotli.compress(body)
+        except ImportError:
+            pass
+
+def load_static_assets():
+    assets = {}
+    for name in sorted(os.listdir(STATIC_DIR)):
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            assets[name] = StaticAsset(name, f.read())
+    return assets
+
+static_assets = load_static_assets()
+static_assets_by_url = {asset.url_name: asset for asset in static_assets.values()}
+
+def asset_url(name):
+    return f"/assets/{static_assets[name].url_name}"
+
+# --- 14. HTML Template ---
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="ja"><head><title>AI Chat</title><meta name="viewport" content="width=device-width, initial-scale=1.0"><meta charset="UTF-8">
-<style>
-    :root { --bg-color: #f7f9fc; --text-color: #000; --sidebar-bg: #ffffff; --border-color: #ddd; --user-bubble-bg: #0b93f6; --model-bubble-bg: #e5e5ea; --input-area-bg: #f0f2f5; }
-    body.dark-mode { --bg-color: #121212; --text-color: #e0e0e0; --sidebar-bg: #1e1e1e; --border-color: #444; --user-bubble-bg: #377dff; --model-bubble-bg: #333333; --input-area-bg: #2a2a2a; }
-    html, body { height: 100%; margin: 0; font-family: sans-serif; background-color: var(--bg-color); color: var(--text-color); }
-    .wrapper { display: flex; height: 100vh; }
-    .sidebar { width: 320px; padding: 20px; border-right: 1px solid var(--border-color); background-color: var(--sidebar-bg); display: flex; flex-direction: column; overflow-y: auto; flex-shrink: 0;}
-    .chat-wrapper { flex-grow: 1; display: flex; flex-direction: column; height: 100vh; }
-    .chat-history { flex-grow: 1; overflow-y: auto; padding: 20px; display: flex; flex-direction: column; }
-    .message { display: flex; margin-bottom: 20px; max-width: 80%; }
-    .message-bubble { padding: 10px 15px; border-radius: 18px; line-height: 1.5; white-space: pre-wrap; word-wrap: break-word;}
-    .user-message { align-self: flex-end; } .user-message .message-bubble { background-color: var(--user-bubble-bg); color: white; }
-    .model-message { align-self: flex-start; } .model-message .message-bubble { background-color: var(--model-bubble-bg); color: var(--text-color); }
-    .input-area { padding: 15px; border-top: 1px solid var(--border-color); background-color: var(--input-area-bg); }
-    .input-area form { display: flex; gap: 10px; align-items: center; }
-    .input-area textarea { flex-grow: 1; border: 1px solid var(--border-color); border-radius: 18px; padding: 10px 15px; resize: none; font-size: 16px; max-height: 120px; background-color: var(--sidebar-bg); color: var(--text-color); }
-    .input-area button { background: #0b93f6; color: white; border: none; border-radius: 50%; width: 40px; height: 40px; font-size: 20px; cursor: pointer; flex-shrink: 0; }
-    label { font-weight: bold; margin-top: 15px; margin-bottom: 5px; display: block; }
-    select, input[type=number], input[type=file], .sidebar textarea { width: 100%; padding: 8px; border: 1px solid var(--border-color); border-radius: 5px; box-sizing: border-box; background-color: var(--bg-color); color: var(--text-color);}
-    #file-list { font-size: 12px; margin-top: 5px; }
-    .file-item { display: flex; justify-content: space-between; align-items: center; margin-bottom: 3px; }
-    .file-item span { overflow: hidden; text-overflow: ellipsis; white-space: nowrap; padding-right: 5px;}
-    .file-item button { background: #dc3545; color: white; border: none; border-radius: 4px; padding: 1px 6px; font-size: 12px; cursor: pointer; }
-    .theme-toggle { position: fixed; top: 10px; right: 10px; cursor: pointer; font-size: 24px; z-index: 100; }
-    .login-container { text-align: center; padding-top: 50px; }
-    .login-btn { background-color: #4285F4; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; }
-    .user-info { padding: 10px; text-align: center; border-bottom: 1px solid var(--border-color); font-size: 12px;}
-    .deep-think-toggle { margin-top: 15px; display: flex; align-items: center; }
-</style></head>
-<body>
+<link rel="stylesheet" href="{{ asset_url('app.css') }}">
+<script src="{{ asset_url('app.js') }}" defer></script></head>
+<body data-logged-in="{{ 'true' if user else 'false' }}">
     <div class="theme-toggle" id="theme-toggle">🌓</div>
     <div class="wrapper">
         <div class="sidebar">
             <div class="user-info">
                 {% if user %}
-                    <p>{{ user.name }}としてログイン中</p>
+                    <p>{{ user }}としてログイン中</p>
                     <a href="/logout">ログアウト</a>
                 {% else %}
                     <a href="/login" class="login-btn">Googleでログイン</a>
@@ -111,6 +1634,11 @@ HTML_TEMPLATE = """
                 <label for="knowledge_file">知識ファイル (最大10件):</label>
                 <input type="file" id="knowledge_file" name="knowledge_file" accept=".txt" multiple>
                 <div id="file-list"></div>
+                {% if user %}
+                    <label for="history_import">会話履歴:</label>
+                    <a href="/history/export?gzip=1" download>エクスポート</a>
+                    <input type="file" id="history_import" name="history_import" accept=".ndjson,.jsonl,.gz">
+                {% endif %}
             </div>
         </div>
         <div class="chat-wrapper">
@@ -120,171 +1648,21 @@ HTML_TEMPLATE = """
                     <p>全ての機能を利用するには、Googleアカウントでログインしてください。</p>
                 </div>
              {% else %}
-                <div class="chat-history" id="chat-history">
-                    {% for item in history %}
-                    <div class="message {% if item.role == 'user' %}user-message{% else %}model-message{% endif %}">
-                        <div class="message-bubble"><p>{{ item.text }}</p></div>
-                    </div>
-                    {% endfor %}
-                </div>
+                <div class="chat-history" id="chat-history"></div>
                 <div class="input-area">
                     <form id="chat-form"><textarea name="prompt" placeholder="メッセージを入力..." required></textarea><button type="submit">↑</button></form>
                 </div>
              {% endif %}
         </div>
     </div>
-    <script>
-        document.addEventListener('DOMContentLoaded', () => {
-            const isLoggedIn = {{ 'true' if user else 'false' }};
-            const themeToggle = document.getElementById('theme-toggle');
-
-            themeToggle.addEventListener('click', () => {
-                document.body.classList.toggle('dark-mode');
-                localStorage.setItem('theme', document.body.classList.contains('dark-mode') ? 'dark' : 'light');
-            });
-            if (localStorage.getItem('theme') === 'dark') {
-                document.body.classList.add('dark-mode');
-            }
-
-            if (isLoggedIn) {
-                const chatForm = document.getElementById('chat-form');
-                const promptInput = chatForm.querySelector('textarea[name="prompt"]');
-                const chatHistory = document.getElementById('chat-history');
-                const fileInput = document.getElementById('knowledge_file');
-                const fileListDiv = document.getElementById('file-list');
-                let knowledgeFiles = [];
-
-                function saveSettings() {
-                    const settings = {
-                        model_name: document.getElementById('model_name').value,
-                        temperature: document.getElementById('temperature').value,
-                        system_instruction: document.getElementById('system_instruction').value,
-                        deep_think_mode: document.getElementById('deep_think_mode').checked
-                    };
-                    localStorage.setItem('ai_settings', JSON.stringify(settings));
-                    localStorage.setItem('knowledge_files', JSON.stringify(knowledgeFiles));
-                }
-
-                function loadSettings() {
-                    const savedSettings = JSON.parse(localStorage.getItem('ai_settings')) || {};
-                    const savedFiles = JSON.parse(localStorage.getItem('knowledge_files')) || [];
-                    
-                    const models = ['gemini-1.5-flash', 'gemini-2.5-pro', 'gemini-1.0-pro'];
-                    const modelSelect = document.getElementById('model_name');
-                    modelSelect.innerHTML = '';
-                    models.forEach(model => {
-                        const option = document.createElement('option');
-                        option.value = model;
-                        option.text = model.replace(/gemini-|-pro|-flash/g, m => ({'gemini-': 'Gemini ', '-pro': ' Pro', '-flash': ' Flash'})[m]);
-                        if (model === (savedSettings.model_name || 'gemini-1.5-flash')) { option.selected = true; }
-                        modelSelect.appendChild(option);
-                    });
-                    document.getElementById('temperature').value = savedSettings.temperature || 1.0;
-                    document.getElementById('system_instruction').value = savedSettings.system_instruction || 'あなたは親切で優秀なAIアシスタントです。';
-                    document.getElementById('deep_think_mode').checked = savedSettings.deep_think_mode || false;
-                    
-                    knowledgeFiles = savedFiles;
-                    renderFileList();
-                }
-
-                ['model_name', 'temperature', 'system_instruction', 'deep_think_mode'].forEach(id => {
-                    document.getElementById(id).addEventListener('change', saveSettings);
-                    document.getElementById(id).addEventListener('input', saveSettings);
-                });
-                
-                fileInput.addEventListener('change', (event) => {
-                    const newFiles = Array.from(event.target.files);
-                    if (knowledgeFiles.length + newFiles.length > 10) { alert("ファイルは合計10個までです。"); return; }
-                    newFiles.forEach(file => {
-                        if (!knowledgeFiles.some(f => f.name === file.name)) {
-                            const reader = new FileReader();
-                            reader.onload = (e) => {
-                                knowledgeFiles.push({ name: file.name, content: e.target.result });
-                                renderFileList();
-                                saveSettings();
-                            };
-                            reader.readAsText(file, 'UTF-8');
-                        }
-                    });
-                    event.target.value = '';
-                });
-
-                function renderFileList() {
-                    fileListDiv.innerHTML = '';
-                    knowledgeFiles.forEach((file, index) => {
-                        const fileItem = document.createElement('div'); fileItem.className = 'file-item';
-                        const fileNameSpan = document.createElement('span'); fileNameSpan.innerText = file.name;
-                        const deleteBtn = document.createElement('button'); deleteBtn.innerText = '×';
-                        deleteBtn.onclick = () => { knowledgeFiles.splice(index, 1); renderFileList(); saveSettings(); };
-                        fileItem.appendChild(fileNameSpan); fileItem.appendChild(deleteBtn); fileListDiv.appendChild(fileItem);
-                    });
-                }
-                
-                chatForm.addEventListener('submit', async function(event) {
-                    event.preventDefault();
-                    const userPrompt = promptInput.value.trim();
-                    if (!userPrompt) return;
-                    appendMessage(userPrompt, 'user');
-                    promptInput.value = ''; promptInput.style.height = 'auto';
-                    const modelBubble = appendMessage('...', 'model');
-                    
-                    saveSettings();
-                    
-                    let historyText = "";
-                    const messages = document.querySelectorAll('.chat-history .message');
-                    messages.forEach(msg => {
-                        const role = msg.classList.contains('user-message') ? 'User' : 'AI';
-                        const text = msg.querySelector('p').innerText;
-                        historyText += `${role}: ${text}\\n`;
-                    });
-
-                    const payload = {
-                        prompt: userPrompt,
-                        model_name: document.getElementById('model_name').value,
-                        temperature: document.getElementById('temperature').value,
-                        system_instruction: document.getElementById('system_instruction').value,
-                        knowledge_files: knowledgeFiles,
-                        deep_think_mode: document.getElementById('deep_think_mode').checked,
-                        history_text: historyText
-                    };
-                    
-                    try {
-                        const response = await fetch('/stream_chat', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) });
-                        if (!response.ok) throw new Error(`Server error: ${response.status} ${await response.text()}`);
-                        const reader = response.body.getReader();
-                        const decoder = new TextDecoder();
-                        let fullResponse = "";
-                        modelBubble.querySelector('p').innerText = "";
-                        while (true) {
-                            const { value, done } = await reader.read();
-                            if (done) break;
-                            const chunk = decoder.decode(value, {stream: true});
-                            fullResponse += chunk;
-                            modelBubble.querySelector('p').innerText = fullResponse;
-                            chatHistory.scrollTop = chatHistory.scrollHeight;
-                        }
-                    } catch (error) { modelBubble.querySelector('p').innerText = "エラーが発生しました: " + error; }
-                });
-
-                function appendMessage(text, role) {
-                    const messageDiv = document.createElement('div'); messageDiv.className = `message ${role}-message`;
-                    const bubbleDiv = document.createElement('div'); bubbleDiv.className = 'message-bubble';
-                    const p = document.createElement('p'); p.innerText = text;
-                    bubbleDiv.appendChild(p); messageDiv.appendChild(bubbleDiv); chatHistory.appendChild(messageDiv);
-                    chatHistory.scrollTop = chatHistory.scrollHeight;
-                    return bubbleDiv;
-                }
-
-                loadSettings();
-                chatHistory.scrollTop = chatHistory.scrollHeight;
-            }
-        });
-    </script>
 </body>
 </html>
 """
+# Compiled once at import; the shell only varies with the user name, so it is revalidated by ETag.
+PAGE_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+PAGE_SHELL_VERSION = hashlib.sha256((HTML_TEMPLATE + ''.join(a.etag for a in static_assets.values())).encode('utf-8')).hexdigest()
 
-# --- 5. Python Backend Routes ---
+# --- 15. Python Backend Routes ---
 @app.route('/login')
 def login():
     flow = get_oauth_flow()
@@ -302,103 +1680,320 @@ def logout():
 def callback():
     flow = get_oauth_flow()
     if not flow: return "OAuth is not configured.", 500
+    started = time.perf_counter()
     try:
         flow.fetch_token(authorization_response=request.url, state=session["state"])
         creds = flow.credentials
-        user_info_response = requests.get('https://www.googleapis.com/oauth2/v1/userinfo', headers={'Authorization': f'Bearer {creds.token}'})
+        user_info_response = get_http_session().get('https://www.googleapis.com/oauth2/v1/userinfo', headers={'Authorization': f'Bearer {creds.token}'})
         user_info = user_info_response.json()
         session['google_id'] = user_info['id']
         session['name'] = user_info['name']
     except Exception as e:
         print(f"Error during OAuth callback: {e}")
+    OAUTH_CALLBACK_SECONDS.observe(time.perf_counter() - started)
     return redirect(url_for('home'))
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+def read_limited(stream, limit):
+    # Reads until EOF or one byte past `limit`, whichever comes first.
+    parts, size = [], 0
+    while size <= limit:
+        part = stream.read(min(65536, limit + 1 - size))
+        if not part: break
+        parts.append(part)
+        size += len(part)
+    return b''.join(parts)
+
+@app.route('/knowledge/blobs/<sha256>', methods=['PUT'])
+def upload_knowledge_blob(sha256):
+    # The body is the file's UTF-8 text, optionally with Content-Encoding: gzip; its SHA-256 must match the URL.
+    if 'google_id' not in session: abort(401)
+    if not SHA256_RE.match(sha256): abort(404)
+    if not blob_store.missing([sha256]):
+        return jsonify(sha256=sha256), 200
+    if (request.content_length or 0) > KNOWLEDGE_MAX_FILE_BYTES:
+        return jsonify(error="ファイルが大きすぎます。"), 413
+    # Chunked uploads carry no Content-Length, so never buffer more than the limit allows.
+    body = read_limited(request.stream, KNOWLEDGE_MAX_FILE_BYTES)
+    if len(body) > KNOWLEDGE_MAX_FILE_BYTES:
+        return jsonify(error="ファイルが大きすぎます。"), 413
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        try:
+            inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            body = inflater.decompress(body, KNOWLEDGE_MAX_FILE_BYTES + 1)
+        except zlib.error:
+            return jsonify(error="圧縮データを展開できません。"), 400
+    if len(body) > KNOWLEDGE_MAX_FILE_BYTES:
+        return jsonify(error="ファイルが大きすぎます。"), 413
+    if hashlib.sha256(body).hexdigest() != sha256:
+        return jsonify(error="ハッシュが内容と一致しません。"), 400
+    try:
+        text = body.decode('utf-8')
+    except UnicodeDecodeError:
+        return jsonify(error="UTF-8のテキストファイルのみ対応しています。"), 400
+    blob_store.put(sha256, text)
+    return jsonify(sha256=sha256), 201
+
+@app.route('/knowledge/blobs/check', methods=['POST'])
+def check_knowledge_blobs():
+    if 'google_id' not in session: abort(401)
+    hashes = (request.get_json(silent=True) or {}).get('hashes', [])
+    if not (isinstance(hashes, list) and all(isinstance(h, str) and SHA256_RE.match(h) for h in hashes)):
+        return jsonify(error="ハッシュの形式が正しくありません。"), 400
+    return jsonify(missing=blob_store.missing(hashes[:KNOWLEDGE_MAX_FILES]))
+
 @app.route('/', methods=['GET'])
 def home():
     user_data = session.get('name')
-    history = []
-    if 'google_id' in session:
-        try:
-            user_id = session['google_id']
-            db = get_db()
-            docs = db.collection('users').document(user_id).collection('conversations').order_by('timestamp').limit(50).stream()
-            for doc in docs:
-                history.append(doc.to_dict())
-        except Exception as e:
-            print(f"Error fetching history for user {session.get('google_id')}: {e}")
-    return render_template_string(HTML_TEMPLATE, user=user_data, history=history)
-    
+    etag = hashlib.sha256(f"{PAGE_SHELL_VERSION}:{user_data}".encode('utf-8')).hexdigest()[:16]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(PAGE_TEMPLATE.render(user=user_data, asset_url=asset_url), mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/assets/<name>', methods=['GET'])
+def static_asset(name):
+    asset = static_assets_by_url.get(name)
+    if asset is None: abort(404)
+    encoding = request.accept_encodings.best_match([e for e in ('br', 'gzip') if e in asset.variants]) or 'identity'
+    etag = f"{asset.etag}-{encoding}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if encoding != 'identity': response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/history', methods=['GET'])
+def history():
+    if 'google_id' not in session: abort(401)
+    try:
+        limit = max(1, min(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 100))
+        before = request.args.get('before')
+        before = datetime.datetime.fromisoformat(before) if before else None
+        if before is not None and before.tzinfo is None: before = before.replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return jsonify(error="limit または before の形式が正しくありません。"), 400
+    turns, has_more = get_history_page(session['google_id'], limit, before)
+    response = jsonify(
+        turns=[{'role': t['role'], 'text': t['text'], 'timestamp': t['timestamp'].isoformat()} for t in turns],
+        next_cursor=turns[0]['timestamp'].isoformat() if has_more and turns else None,
+    )
+    response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+@app.route('/history/export', methods=['GET'])
+def export_history_route():
+    if 'google_id' not in session: abort(401)
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    filename = 'history.ndjson.gz' if compress else 'history.ndjson'
+    return Response(export_history(session['google_id'], compress),
+                    mimetype='application/gzip' if compress else 'application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"', 'Cache-Control': 'no-store'})
+
+@app.route('/history/import', methods=['POST'])
+def import_history_route():
+    # NDJSON in the export format, optionally sent with Content-Encoding: gzip; read and written incrementally.
+    if 'google_id' not in session: abort(401)
+    stream = request.stream
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    try:
+        imported, errors = import_history(session['google_id'], stream)
+    except (OSError, EOFError, zlib.error) as e:
+        return jsonify(error=f"圧縮データを展開できません: {e}"), 400
+    except RuntimeError as e:
+        return jsonify(error=str(e)), 500
+    return jsonify(imported=imported, errors=errors)
+
+@app.route('/response_cache/stats', methods=['GET'])
+def response_cache_stats():
+    return jsonify(response_cache.snapshot())
+
 @app.route('/stream_chat', methods=['POST'])
 def stream_chat():
-    def generate():
-        try:
-            data = request.get_json()
-            user_prompt = data.get('prompt', "")
-            
-            is_deep_think = data.get('deep_think_mode', False)
-            if is_deep_think:
-                model_name = 'gemini-2.5-pro'
-                temperature = 0.5
-                system_instruction = "あなたは非常に慎重で論理的な専門家です。ユーザーの質問に対して、まず背景、複数の視点、そして段階的な思考プロセスを内部で整理してください。その上で、最も論理的で包括的な回答を生成してください。"
-            else:
-                model_name = data.get('model_name', 'gemini-1.5-flash')
-                temperature = float(data.get('temperature', 1.0))
-                system_instruction = data.get('system_instruction', "")
-
-            knowledge_files = data.get('knowledge_files', [])
-            history_text = data.get('history_text', '')
-            
-            # ▼▼▼ BUG FIX: Use the get_genai() function to get the client ▼▼▼
-            genai_client = get_genai()
-            if not (genai_client and user_prompt):
-                yield "エラー: GEMINI_API_KEYが設定されていないか、プロンプトが空です。"
-                return
+    try:
+        turn, error = prepare_chat(request.get_json(), session.get('google_id'))
+    except MissingBlobs as e:
+        return Response(sse_event({'missing': e.hashes}, event='missing'), mimetype='text/event-stream', headers=SSE_HEADERS)
+    except Exception as e:
+        print(f"Error during generation: {e}")
+        turn, error = None, f"API呼び出し中にエラーが発生しました: {e}"
+    if error:
+        return Response(sse_event(error, event='error'), mimetype='text/event-stream', headers=SSE_HEADERS)
+    stream = start_generation(turn)
+    return Response(sse_stream(stream, 0), mimetype='text/event-stream', headers=SSE_HEADERS)
 
-            model = genai_client.GenerativeModel(
-                model_name=model_name,
-                # ▼▼▼ BUG FIX: Access GenerationConfig through the client instance ▼▼▼
-                generation_config=genai_client.GenerationConfig(temperature=temperature),
-                system_instruction=system_instruction,
-            )
-            
-            final_prompt = user_prompt
-            context_header = ""
-            context_body = ""
-
-            if knowledge_files:
-                context_header += "知識ファイル"
-                context_body += "\\n\\n".join([f"--- File: {f['name']} ---\\n{f['content']}" for f in knowledge_files])
-
-            if history_text:
-                if context_header: context_header += "と"
-                context_header += "これまでの会話履歴"
-                if context_body: context_body += "\\n\\n"
-                context_body += f"--- 会話履歴 ---\\n{history_text}"
-
-            if context_header:
-                final_prompt = f"以下の{context_header}を元に回答してください。\\n{context_body}\\n--------------\\nユーザーの質問: {user_prompt}"
-
-            chat = model.start_chat(history=[])
-            response_stream = chat.send_message(final_prompt, stream=True)
-            
-            full_ai_response = ""
-            for chunk in response_stream:
-                if chunk.text:
-                    full_ai_response += chunk.text
-                    yield chunk.text
-            
-            if 'google_id' in session:
-                user_id = session['google_id']
-                db = get_db()
-                convo_ref = db.collection('users').document(user_id).collection('conversations')
-                utc_now = datetime.datetime.now(datetime.timezone.utc)
-                convo_ref.add({'role': 'user', 'text': user_prompt, 'timestamp': utc_now})
-                convo_ref.add({'role': 'model', 'text': full_ai_response, 'timestamp': utc_now + datetime.timedelta(microseconds=1)})
-        except Exception as e:
-            print(f"Error during generation: {e}")
-            yield f"API呼び出し中にエラーが発生しました: {e}"
+@app.route('/stream_chat/<stream_id>', methods=['GET'])
+def resume_stream_chat(stream_id):
+    stream = stream_registry.get(stream_id)
+    if stream is None or stream.user_id != session.get('google_id'): abort(404)
+    after = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    return Response(sse_stream(stream, after), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+# --- 16. ASGI Entry Point ---
+# `uvicorn main:asgi_app` serves /stream_chat and its resumptions natively on the event loop, following
+# the generation buffers without holding a thread per response; every other route runs the Flask app on a
+# thread pool, with the request body read and the response sent incrementally so bulk transfers stay flat.
+wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await asgi_lifespan(receive, send)
+    if scope['type'] == 'http' and scope['path'] == '/stream_chat' and scope['method'] == 'POST':
+        return await asgi_stream_chat(scope, receive, send)
+    if scope['type'] == 'http' and scope['path'].startswith('/stream_chat/') and scope['method'] == 'GET':
+        return await asgi_resume_stream_chat(scope, receive, send)
+    if scope['type'] != 'http': return
+    loop = asyncio.get_running_loop()
+    environ = asgi_environ(scope, io.BufferedReader(AsgiInput(receive, loop)))
+    status, headers, result, iterator, chunk = await loop.run_in_executor(wsgi_executor, start_wsgi, environ)
+    try:
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        while chunk is not None:
+            if chunk: await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(wsgi_executor, next, iterator, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'): await loop.run_in_executor(wsgi_executor, result.close)
+
+async def asgi_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect': return None
+        body += message.get('body', b'')
+        if not message.get('more_body'): return body
+
+class AsgiInput(io.RawIOBase):
+    """wsgi.input for a pool thread: pulls request body messages from the event loop as the app reads."""
 
-    return Response(stream_with_context(generate()), mimetype='text/plain; charset=utf-8')
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and self._more:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect': raise OSError("client disconnected")
+            self._buffer += message.get('body', b'')
+            self._more = message.get('more_body', False)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+def asgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]), 'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body, 'wsgi.input_terminated': True, 'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True, 'wsgi.multiprocess': True, 'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def start_wsgi(environ):
+    # Returns (status, headers, result, its iterator, first chunk or None); pulling the first chunk settles lazy start_response calls.
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]]
+    result = app(environ, start_response)
+    iterator = iter(result)
+    try:
+        chunk = next(iterator, None)
+    except BaseException:
+        if hasattr(result, 'close'): result.close()
+        raise
+    return started[0], started[1], result, iterator, chunk
+
+async def asgi_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await asyncio.to_thread(turn_writer.close)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+def asgi_session(scope):
+    # Decode the signed Flask session cookie exactly as the Flask routes would.
+    with app.request_context(asgi_environ(scope, io.BytesIO())):
+        return dict(session)
+
+async def asgi_stream_chat(scope, receive, send):
+    body = await asgi_body(receive)
+    if body is None: return
+    user_id = asgi_session(scope).get('google_id')
+    try:
+        # Firestore reads stay blocking, so request preparation runs briefly on the default executor.
+        turn, error = await asyncio.to_thread(prepare_chat, json.loads(body), user_id)
+    except MissingBlobs as e:
+        return await asgi_send_events(send, [sse_event({'missing': e.hashes}, event='missing')])
+    except Exception as e:
+        print(f"Error during generation: {e}")
+        turn, error = None, f"API呼び出し中にエラーが発生しました: {e}"
+    if error:
+        return await asgi_send_events(send, [sse_event(error, event='error')])
+    await asgi_follow_stream(send, start_generation(turn), 0)
+
+async def asgi_resume_stream_chat(scope, receive, send):
+    stream = stream_registry.get(scope['path'].rsplit('/', 1)[-1])
+    if stream is None or stream.user_id != asgi_session(scope).get('google_id'):
+        await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-type', b'text/plain')]})
+        return await send({'type': 'http.response.body', 'body': b'Not Found'})
+    headers = dict(scope['headers'])
+    query = dict(urllib.parse.parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+    after = parse_last_event_id(headers.get(b'last-event-id', b'').decode('latin-1') or query.get('last_event_id'))
+    await asgi_follow_stream(send, stream, after)
+
+ASGI_SSE_HEADERS = [(b'content-type', b'text/event-stream; charset=utf-8')] + [(k.lower().encode(), v.encode()) for k, v in SSE_HEADERS.items()]
+
+async def asgi_send_events(send, events):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': ASGI_SSE_HEADERS})
+    for event in events:
+        await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+async def asgi_follow_stream(send, stream, after):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': ASGI_SSE_HEADERS})
+    async def emit(event):
+        await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+    if after == 0: await emit(sse_event({'stream_id': stream.id}, event='stream'))
+    try:
+        async for chunk in stream.afollow(after):
+            await emit(sse_chunk(chunk))
+        await emit(sse_end(stream))
+    except StreamGap:
+        await emit(sse_event("再開できる範囲を超えました。もう一度送信してください。", event='error'))
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
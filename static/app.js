@@ -0,0 +1,275 @@
+document.addEventListener('DOMContentLoaded', () => {
+    const isLoggedIn = document.body.dataset.loggedIn === 'true';
+    const themeToggle = document.getElementById('theme-toggle');
+
+    themeToggle.addEventListener('click', () => {
+        document.body.classList.toggle('dark-mode');
+        localStorage.setItem('theme', document.body.classList.contains('dark-mode') ? 'dark' : 'light');
+    });
+    if (localStorage.getItem('theme') === 'dark') {
+        document.body.classList.add('dark-mode');
+    }
+
+    if (isLoggedIn) {
+        const chatForm = document.getElementById('chat-form');
+        const promptInput = chatForm.querySelector('textarea[name="prompt"]');
+        const chatHistory = document.getElementById('chat-history');
+        const fileInput = document.getElementById('knowledge_file');
+        const fileListDiv = document.getElementById('file-list');
+        let knowledgeFiles = [];
+
+        function saveSettings() {
+            const settings = {
+                model_name: document.getElementById('model_name').value,
+                temperature: document.getElementById('temperature').value,
+                system_instruction: document.getElementById('system_instruction').value,
+                deep_think_mode: document.getElementById('deep_think_mode').checked
+            };
+            localStorage.setItem('ai_settings', JSON.stringify(settings));
+            localStorage.setItem('knowledge_files', JSON.stringify(knowledgeFiles));
+        }
+
+        function loadSettings() {
+            const savedSettings = JSON.parse(localStorage.getItem('ai_settings')) || {};
+            const savedFiles = JSON.parse(localStorage.getItem('knowledge_files')) || [];
+
+            const models = ['gemini-1.5-flash', 'gemini-2.5-pro', 'gemini-1.0-pro'];
+            const modelSelect = document.getElementById('model_name');
+            modelSelect.innerHTML = '';
+            models.forEach(model => {
+                const option = document.createElement('option');
+                option.value = model;
+                option.text = model.replace(/gemini-|-pro|-flash/g, m => ({'gemini-': 'Gemini ', '-pro': ' Pro', '-flash': ' Flash'})[m]);
+                if (model === (savedSettings.model_name || 'gemini-1.5-flash')) { option.selected = true; }
+                modelSelect.appendChild(option);
+            });
+            document.getElementById('temperature').value = savedSettings.temperature || 1.0;
+            document.getElementById('system_instruction').value = savedSettings.system_instruction || 'あなたは親切で優秀なAIアシスタントです。';
+            document.getElementById('deep_think_mode').checked = savedSettings.deep_think_mode || false;
+
+            knowledgeFiles = savedFiles;
+            renderFileList();
+        }
+
+        ['model_name', 'temperature', 'system_instruction', 'deep_think_mode'].forEach(id => {
+            document.getElementById(id).addEventListener('change', saveSettings);
+            document.getElementById(id).addEventListener('input', saveSettings);
+        });
+
+        // Knowledge files are uploaded once as content-addressed blobs; chats only send their hashes.
+        async function sha256Hex(bytes) {
+            const digest = await crypto.subtle.digest('SHA-256', bytes);
+            return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+        }
+
+        async function uploadKnowledgeBlob(file) {
+            let body = new TextEncoder().encode(file.content);
+            const headers = { 'Content-Type': 'text/plain; charset=utf-8' };
+            if (window.CompressionStream) {
+                body = await new Response(new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'))).arrayBuffer();
+                headers['Content-Encoding'] = 'gzip';
+            }
+            const response = await fetch(`/knowledge/blobs/${file.sha256}`, { method: 'PUT', headers: headers, body: body });
+            if (!response.ok) { const err = await response.json().catch(() => ({})); alert(err.error || `Upload failed: ${response.status}`); return false; }
+            return true;
+        }
+
+        async function uploadMissingBlobs(hashes) {
+            const wanted = new Set(hashes);
+            for (const file of knowledgeFiles.filter(f => wanted.has(f.sha256))) {
+                if (!await uploadKnowledgeBlob(file)) return false;
+            }
+            return true;
+        }
+
+        // The server's blob store is a cache; re-upload whatever it no longer holds since the last visit.
+        async function syncKnowledgeFiles() {
+            for (const file of knowledgeFiles.filter(f => !f.sha256)) {
+                file.sha256 = await sha256Hex(new TextEncoder().encode(file.content));
+            }
+            saveSettings();
+            if (!knowledgeFiles.length) return;
+            const response = await fetch('/knowledge/blobs/check', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ hashes: knowledgeFiles.map(f => f.sha256) }) });
+            if (!response.ok) return;
+            await uploadMissingBlobs((await response.json()).missing);
+        }
+
+        fileInput.addEventListener('change', (event) => {
+            const newFiles = Array.from(event.target.files);
+            if (knowledgeFiles.length + newFiles.length > 10) { alert("ファイルは合計10個までです。"); return; }
+            newFiles.forEach(file => {
+                if (!knowledgeFiles.some(f => f.name === file.name)) {
+                    const reader = new FileReader();
+                    reader.onload = async (e) => {
+                        const newFile = { name: file.name, content: e.target.result };
+                        newFile.sha256 = await sha256Hex(new TextEncoder().encode(newFile.content));
+                        if (!await uploadKnowledgeBlob(newFile)) return;
+                        knowledgeFiles.push(newFile);
+                        renderFileList();
+                        saveSettings();
+                    };
+                    reader.readAsText(file, 'UTF-8');
+                }
+            });
+            event.target.value = '';
+        });
+
+        function renderFileList() {
+            fileListDiv.innerHTML = '';
+            knowledgeFiles.forEach((file, index) => {
+                const fileItem = document.createElement('div'); fileItem.className = 'file-item';
+                const fileNameSpan = document.createElement('span'); fileNameSpan.innerText = file.name;
+                const deleteBtn = document.createElement('button'); deleteBtn.innerText = '×';
+                deleteBtn.onclick = () => { knowledgeFiles.splice(index, 1); renderFileList(); saveSettings(); };
+                fileItem.appendChild(fileNameSpan); fileItem.appendChild(deleteBtn); fileListDiv.appendChild(fileItem);
+            });
+        }
+
+        // Minimal text/event-stream parser for fetch() responses (EventSource cannot POST).
+        async function readEvents(response, onEvent) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) return;
+                buffer += decoder.decode(value, {stream: true});
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const block = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    const message = { event: 'message', id: null, data: '' };
+                    block.split('\n').forEach(line => {
+                        const sep = line.indexOf(':');
+                        if (sep <= 0) return;
+                        const field = line.slice(0, sep), value = line.slice(sep + 1).replace(/^ /, '');
+                        if (field === 'event') message.event = value;
+                        else if (field === 'id') message.id = value;
+                        else if (field === 'data') message.data += value;
+                    });
+                    if (message.data) onEvent(message);
+                }
+            }
+        }
+
+        chatForm.addEventListener('submit', async function(event) {
+            event.preventDefault();
+            const userPrompt = promptInput.value.trim();
+            if (!userPrompt) return;
+            appendMessage(userPrompt, 'user');
+            promptInput.value = ''; promptInput.style.height = 'auto';
+            const modelBubble = appendMessage('...', 'model');
+
+            saveSettings();
+
+            const payload = {
+                prompt: userPrompt,
+                model_name: document.getElementById('model_name').value,
+                temperature: document.getElementById('temperature').value,
+                system_instruction: document.getElementById('system_instruction').value,
+                deep_think_mode: document.getElementById('deep_think_mode').checked,
+                knowledge: knowledgeFiles.map(f => ({ name: f.name, sha256: f.sha256 }))
+            };
+
+            const bubbleText = modelBubble.querySelector('p');
+            let fullResponse = "";
+            let streamId = null;
+            let lastEventId = 0;
+            let finished = false;
+            let missingBlobs = null;
+            const onEvent = (message) => {
+                const data = JSON.parse(message.data);
+                if (message.event === 'missing') { missingBlobs = data.missing; }
+                else if (message.event === 'stream') { streamId = data.stream_id; bubbleText.innerText = ""; }
+                else if (message.event === 'done') { finished = true; }
+                else if (message.event === 'error') { finished = true; bubbleText.innerText = fullResponse ? `${fullResponse}\n${data}` : data; }
+                else {
+                    lastEventId = Number(message.id);
+                    fullResponse += data;
+                    bubbleText.innerText = fullResponse;
+                    chatHistory.scrollTop = chatHistory.scrollHeight;
+                }
+            };
+
+            let request = fetch('/stream_chat', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) });
+            for (let attempt = 0; ; attempt++) {
+                let failure = null;
+                try {
+                    const response = await request;
+                    if (!response.ok) throw new Error(`Server error: ${response.status} ${await response.text()}`);
+                    await readEvents(response, onEvent);
+                } catch (error) { failure = error; }
+                if (finished) break;
+                if (missingBlobs) {
+                    // The server evicted some of our files: upload them again and resend the message once.
+                    const hashes = missingBlobs;
+                    missingBlobs = null;
+                    if (attempt > 0 || !await uploadMissingBlobs(hashes)) { bubbleText.innerText = "エラー: 知識ファイルを送信できませんでした。"; break; }
+                    request = fetch('/stream_chat', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) });
+                    continue;
+                }
+                if (!streamId || attempt >= 5) { bubbleText.innerText = "エラーが発生しました: " + (failure || "接続が切断されました"); break; }
+                // The connection dropped mid-answer; the server kept generating, so resume after the last chunk we saw.
+                await new Promise(resolve => setTimeout(resolve, 500 * (attempt + 1)));
+                request = fetch(`/stream_chat/${streamId}`, { headers: { 'Last-Event-ID': String(lastEventId) } });
+            }
+        });
+
+        function createMessage(text, role) {
+            const messageDiv = document.createElement('div'); messageDiv.className = `message ${role}-message`;
+            const bubbleDiv = document.createElement('div'); bubbleDiv.className = 'message-bubble';
+            const p = document.createElement('p'); p.innerText = text;
+            bubbleDiv.appendChild(p); messageDiv.appendChild(bubbleDiv);
+            return messageDiv;
+        }
+
+        function appendMessage(text, role) {
+            const messageDiv = createMessage(text, role);
+            chatHistory.appendChild(messageDiv);
+            chatHistory.scrollTop = chatHistory.scrollHeight;
+            return messageDiv.firstChild;
+        }
+
+        // History is not part of the cacheable page shell: the latest page is fetched on load and
+        // older turns a page at a time when the user scrolls to the top.
+        let nextCursor = null;
+        let loadingOlder = false;
+        async function loadHistoryPage(before) {
+            loadingOlder = true;
+            try {
+                const response = await fetch(before ? `/history?before=${encodeURIComponent(before)}` : '/history');
+                if (!response.ok) return;
+                const page = await response.json();
+                const previousHeight = chatHistory.scrollHeight;
+                const fragment = document.createDocumentFragment();
+                page.turns.forEach(turn => fragment.appendChild(createMessage(turn.text, turn.role)));
+                chatHistory.insertBefore(fragment, chatHistory.firstChild);
+                chatHistory.scrollTop += chatHistory.scrollHeight - previousHeight;
+                nextCursor = page.next_cursor;
+            } finally { loadingOlder = false; }
+        }
+        chatHistory.addEventListener('scroll', () => {
+            if (chatHistory.scrollTop > 50 || !nextCursor || loadingOlder) return;
+            loadHistoryPage(nextCursor);
+        });
+
+        document.getElementById('history_import').addEventListener('change', async (event) => {
+            const file = event.target.files[0];
+            event.target.value = '';
+            if (!file) return;
+            const headers = { 'Content-Type': 'application/x-ndjson' };
+            if (file.name.endsWith('.gz')) headers['Content-Encoding'] = 'gzip';
+            const response = await fetch('/history/import', { method: 'POST', headers: headers, body: file });
+            const result = await response.json().catch(() => ({}));
+            if (!response.ok) { alert(result.error || `Import failed: ${response.status}`); return; }
+            alert(`${result.imported}件の会話をインポートしました。` + (result.errors.length ? ` (${result.errors.length}行をスキップ)` : ''));
+            chatHistory.innerHTML = '';
+            await loadHistoryPage(null);
+            chatHistory.scrollTop = chatHistory.scrollHeight;
+        });
+
+        loadSettings();
+        syncKnowledgeFiles();
+        loadHistoryPage(null).then(() => { chatHistory.scrollTop = chatHistory.scrollHeight; });
+    }
+});